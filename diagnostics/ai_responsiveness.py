@@ -2,28 +2,66 @@
 import subprocess
 import json
 import sys
+import threading
 import time
 import os
+from functools import lru_cache
 
-CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../config.json')
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(PROJECT_ROOT, 'config.json')
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
 
-def load_config():
-    with open(CONFIG_PATH, 'r') as f:
+from diagnostics.diagnostics import stop_sequences, complete_in_process, get_llama_server
+
+@lru_cache(maxsize=4)
+def load_config(path=CONFIG_PATH):
+    with open(path, 'r') as f:
         return json.load(f)
 
-def run_llama_cli(prompt, timeout=30):
+def run_llama_cli(prompt, timeout=30, stop_on_first_line=False):
     config = load_config()
     llama_path = config['llama_cpp_path']
     model_path = config['model_path']
+    text = complete_in_process('raw', model_path, prompt, 64)
+    if text is not None:
+        return text, ''
+    server = get_llama_server(llama_path, model_path)
+    if server is not None:
+        try:
+            res = server.complete(prompt, 64, timeout=timeout, stop=stop_sequences('raw'))
+            return res.get('content', ''), ''
+        except Exception:
+            pass  # fall back to a one-shot llama-cli run
     try:
         proc = subprocess.Popen(
             [llama_path, '--model', model_path, '--log-disable', '--prompt', prompt, '--n-predict', '64'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1
         )
+        # readline() can't time out on its own; killing the process unblocks it
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        started = time.time()
+        lines = []
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                lines.append(line)
+                if stop_on_first_line:
+                    # A liveness check only needs the first generated line, and llama-cli
+                    # echoes the prompt before it; wait for text after the echo
+                    _, echoed, generated = ''.join(lines).partition(prompt)
+                    if echoed and generated.strip():
+                        proc.kill()
+                        break
+        finally:
+            timer.cancel()
+        out = ''.join(lines)
         try:
-            out, err = proc.communicate(timeout=timeout)
+            _, err = proc.communicate(timeout=5)
         except subprocess.TimeoutExpired:
             proc.kill()
+            err = ''
+        if not out.strip() and time.time() - started >= timeout:
             return None, 'Timeout expired'
         return out, err
     except Exception as e:
@@ -32,7 +70,7 @@ def run_llama_cli(prompt, timeout=30):
 def main():
     test_prompt = "Hello! Please reply with any text."
     print(f"[Diagnostics] Sending prompt: {test_prompt}")
-    out, err = run_llama_cli(test_prompt)
+    out, err = run_llama_cli(test_prompt, stop_on_first_line=True)
     if out and out.strip():
         print("[Diagnostics] AI responded:")
         print(out.strip())
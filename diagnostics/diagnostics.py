@@ -1,11 +1,35 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import atexit
+import fcntl
 import json
 import os
+import socket
 import subprocess
 import sys
+import time
+import urllib.error
+import urllib.request
+from functools import lru_cache
 
+try:
+    from llama_cpp import Llama  # optional: in-process llama.cpp bindings
+except ImportError:
+    Llama = None
 
+SERVER_HOST = "127.0.0.1"
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    # A fresh port per server, so nothing else (e.g. a chat session's llama-server) answers for it
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((SERVER_HOST, 0))
+        return sock.getsockname()[1]
+
+
+@lru_cache(maxsize=4)
 def load_config(project_root: str):
     cfg_path = os.path.join(project_root, "config.json")
     if not os.path.exists(cfg_path):
@@ -43,16 +67,224 @@ def run_cmd(cmd: list[str], capture: bool = True) -> subprocess.CompletedProcess
             check=False,
             stdout=subprocess.PIPE if capture else None,
             stderr=subprocess.STDOUT,
+            # Lets CPython launch via posix_spawn instead of fork+exec
+            close_fds=False,
         )
     except FileNotFoundError:
         print(f"[ERROR] Command not found: {cmd[0]}")
         sys.exit(1)
 
 
+class LlamaServer:
+    """A long-lived llama-server process, so the model is loaded once per run.
+
+    ctx is per slot: llama-server splits --ctx-size across its --parallel slots.
+    """
+
+    def __init__(self, server_bin: str, model_path: str, port: int = None,
+                 ctx: str = "4096", n_gpu: str = "999", n_parallel: int = 1):
+        self.server_bin = server_bin
+        self.model_path = model_path
+        self.port = port if port is not None else _free_port()
+        self.ctx = ctx
+        self.n_gpu = n_gpu
+        self.n_parallel = n_parallel
+        self.proc = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{SERVER_HOST}:{self.port}"
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _healthy(self) -> bool:
+        if not self.alive():
+            return False
+        try:
+            with urllib.request.urlopen(self.base_url + "/health", timeout=1) as resp:
+                return resp.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def start(self, timeout: float = 120.0) -> bool:
+        cmd = [
+            self.server_bin,
+            "--model", self.model_path,
+            "--host", SERVER_HOST,
+            "--port", str(self.port),
+            "--ctx-size", str(int(self.ctx) * self.n_parallel),
+            "--n-gpu-layers", self.n_gpu,
+            "--parallel", str(self.n_parallel),
+        ]
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            self.proc = None
+            return False
+        atexit.register(self.stop)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                self.proc = None
+                return False
+            if self._healthy():
+                return True
+            time.sleep(0.25)
+        self.stop()
+        return False
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+    def complete(self, prompt: str, n: int, timeout: float = 300.0, stop=None) -> dict:
+        payload = {
+            "prompt": prompt,
+            "n_predict": n,
+            "temperature": 0.7,
+            "top_k": 40,
+            "top_p": 0.95,
+            "repeat_penalty": 1.1,
+            # Reuse the KV state of a matching prefix (e.g. the shared ChatML system block)
+            "cache_prompt": True,
+        }
+        if stop:
+            # Generation ends at the token level instead of being trimmed afterwards
+            payload["stop"] = list(stop)
+        req = urllib.request.Request(
+            self.base_url + "/completion",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read().decode("utf-8", errors="replace"))
+
+
+_server = None
+_server_failed = set()
+
+
+def server_bin_for(llama_cli: str) -> str:
+    # llama-server is built next to llama-cli in the same bin/ directory
+    return os.path.join(os.path.dirname(llama_cli), "llama-server")
+
+
+def get_llama_server(llama_cli: str, model_path: str, n_parallel: int = 1):
+    """Return a running LlamaServer for model_path, or None if it cannot be started."""
+    global _server
+    if (_server is not None and _server.model_path == model_path and _server.alive()
+            and _server.n_parallel >= n_parallel):
+        return _server
+    if model_path in _server_failed:
+        return None
+    if _server is not None:
+        _server.stop()
+        _server = None
+    server_bin = server_bin_for(llama_cli)
+    if not os.path.exists(server_bin):
+        _server_failed.add(model_path)
+        return None
+    print(f"[info] starting llama-server for {os.path.basename(model_path)} …")
+    server = LlamaServer(server_bin, model_path, n_parallel=n_parallel)
+    if not server.start():
+        print("[warn] llama-server failed to start; falling back to llama-cli")
+        _server_failed.add(model_path)
+        return None
+    _server = server
+    return _server
+
+
+_llama_ok = set()
+
+
+_llm_failed = set()
+
+
+# One model resident at a time: with n_gpu_layers=999 a second one would not fit beside it
+@lru_cache(maxsize=1)
+def _get_llm(model_path: str):
+    return Llama(model_path=model_path, n_gpu_layers=999, n_ctx=4096, verbose=False)
+
+
+@lru_cache(maxsize=2)
+def _chatml_wrapper_tokens(model_path: str):
+    llm = _get_llm(model_path)
+    head = llm.tokenize(_CHATML_HEAD.encode("utf-8"), add_bos=True, special=True)
+    tail = llm.tokenize(_CHATML_TAIL.encode("utf-8"), add_bos=False, special=True)
+    return head, tail
+
+
+# model_path -> whether split tokenization matched the full prompt on first use
+_chatml_split_ok = {}
+
+
+def _chatml_prompt_tokens(llm, model_path: str, user_text: str) -> list[int]:
+    """Tokens of _build_chatml_prompt(user_text), tokenizing the fixed wrapper once per model."""
+    split_ok = _chatml_split_ok.get(model_path)
+    if split_ok is False:
+        return llm.tokenize(_build_chatml_prompt(user_text).encode("utf-8"), add_bos=True, special=True)
+    # llama.cpp tokenizes each run of text between special tokens on its own, so the
+    # "user\n...\n" run cut at <|im_start|> / <|im_end|> comes out as in the full prompt
+    head, tail = _chatml_wrapper_tokens(model_path)
+    toks = head + llm.tokenize(f"user\n{user_text}\n".encode("utf-8"), add_bos=False, special=True) + tail
+    if split_ok is None:
+        # Some vocabularies strip whitespace next to special tokens; check once against the full prompt
+        full = llm.tokenize(_build_chatml_prompt(user_text).encode("utf-8"), add_bos=True, special=True)
+        _chatml_split_ok[model_path] = toks == full
+        if toks != full:
+            print(f"[info] {os.path.basename(model_path)}: split ChatML tokens differ; tokenizing full prompts")
+            return full
+    return toks
+
+
+def complete_in_process(model_type: str, model_path: str, prompt: str, n: int):
+    """Generate with llama-cpp-python; returns None when the bindings are unavailable."""
+    if Llama is None or model_path in _llm_failed:
+        return None
+    try:
+        llm = _get_llm(model_path)
+    except Exception as e:
+        # lru_cache does not keep exceptions; remember the failure like _server_failed does
+        print(f"[warn] llama_cpp failed to load {os.path.basename(model_path)} ({e})")
+        _llm_failed.add(model_path)
+        return None
+    try:
+        if model_type in ("chatml", "chatml-manual"):
+            effective_prompt = _chatml_prompt_tokens(llm, model_path, prompt)
+        else:
+            effective_prompt = prompt
+        res = llm.create_completion(
+            prompt=effective_prompt,
+            max_tokens=n,
+            temperature=0.7,
+            top_k=40,
+            top_p=0.95,
+            repeat_penalty=1.1,
+            stop=stop_sequences(model_type),
+        )
+        return res["choices"][0]["text"]
+    except Exception as e:
+        # e.g. prompt + max_tokens over n_ctx; let the caller fall through to server/CLI
+        print(f"[warn] llama_cpp generation failed ({e}); falling back")
+        return None
+
+
 def check_llama(llama_cli: str):
     print("[check] llama.cpp binary reachable …", end=" ")
+    if llama_cli in _llama_ok:
+        print("ok (cached)")
+        return
     res = run_cmd([llama_cli, "--help"]) 
     if res.returncode == 0 and res.stdout:
+        _llama_ok.add(llama_cli)
         print("ok")
     else:
         print("fail")
@@ -60,10 +292,15 @@ def check_llama(llama_cli: str):
         sys.exit(1)
 
 
-def check_model_load(llama_cli: str, model_path: str, model_type: str):
+def check_model_load(llama_cli: str, model_path: str, model_type: str, quick: bool = False):
     print(f"[check] model loads: {os.path.basename(model_path)} …", end=" ")
-    base = build_base_cmd(llama_cli, model_path, model_type, ctx="1024", n_gpu="999", temp="0.7")
-    test = base + ["-p", "hello", "-n", "16", "--no-display-prompt"]
+    if quick:
+        # Only proves the weights load and a token comes out; keep the KV cache tiny
+        base = build_base_cmd(llama_cli, model_path, model_type, ctx="128", n_gpu="999", temp="0.7")
+        test = base + ["-p", "hello", "-n", "4", "-b", "32", "--no-display-prompt"]
+    else:
+        base = build_base_cmd(llama_cli, model_path, model_type, ctx="1024", n_gpu="999", temp="0.7")
+        test = base + ["-p", "hello", "-n", "16", "--no-display-prompt"]
     res = run_cmd(test)
     if res.returncode == 0:
         print("ok")
@@ -73,12 +310,37 @@ def check_model_load(llama_cli: str, model_path: str, model_type: str):
         sys.exit(1)
 
 
+# Split at the special tokens around the user turn; see _chatml_prompt_tokens
+_CHATML_HEAD = "<|im_start|>system\nYou are a helpful, direct assistant.\n<|im_end|>\n<|im_start|>"
+_CHATML_TAIL = "<|im_end|>\n<|im_start|>assistant\n"
+_CHATML_PREFIX = _CHATML_HEAD + "user\n"
+_CHATML_SUFFIX = "\n" + _CHATML_TAIL
+
+
 def _build_chatml_prompt(user_text: str) -> str:
-    return (
-        "<|im_start|>system\nYou are a helpful, direct assistant.\n<|im_end|>\n"
-        "<|im_start|>user\n" + user_text + "\n<|im_end|>\n"
-        "<|im_start|>assistant\n"
-    )
+    return _CHATML_PREFIX + user_text + _CHATML_SUFFIX
+
+
+def _prompt_cache_path(model_path: str) -> str:
+    # Inside the project's git-ignored cache dir, not a world-writable temp dir
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    cache_dir = os.path.join(PROJECT_ROOT, ".llm_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, f"diag_prefix_{name}.kvcache")
+
+
+def stop_sequences(model_type: str) -> list[str]:
+    stop = ["<|im_end|>", "<|endoftext|>"]
+    if model_type not in ("chatml", "chatml-manual"):
+        stop += ["\nUser:", "\nYou:"]
+    return stop
+
+
+def _completion_prompt(model_type: str, prompt: str) -> str:
+    # /completion applies no chat template, so chatml needs the manual wrapper too
+    if model_type in ("chatml", "chatml-manual"):
+        return _build_chatml_prompt(prompt)
+    return prompt
 
 
 def run_prompt(llama_cli: str, model_path: str, model_type: str, prompt: str, n: int):
@@ -89,10 +351,40 @@ def run_prompt(llama_cli: str, model_path: str, model_type: str, prompt: str, n:
         effective_type = "raw"
         effective_prompt = _build_chatml_prompt(prompt)
 
+    if Llama is not None:
+        print(f"[run] llama_cpp in-process: {os.path.basename(model_path)} (max_tokens={n})")
+        text = complete_in_process(model_type, model_path, prompt, n)
+        if text is not None:
+            print("\n[output]\n" + text)
+            return 0
+
+    server = get_llama_server(llama_cli, model_path)
+    if server is not None:
+        print(f"[run] POST {server.base_url}/completion (n_predict={n})")
+        try:
+            res = server.complete(_completion_prompt(model_type, prompt), n,
+                                  stop=stop_sequences(model_type))
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"[warn] llama-server request failed ({e}); falling back to llama-cli")
+        else:
+            print("\n[output]\n" + (res.get("content") or ""))
+            return 0
+
     base = build_base_cmd(llama_cli, model_path, effective_type, ctx="4096", n_gpu="999", temp="0.7")
+    cache_path = None
+    if model_type == "chatml-manual":
+        # Every prompt shares the ChatML system block; let llama-cli reload its state
+        cache_path = _prompt_cache_path(model_path)
+        base += ["--prompt-cache", cache_path]
     cmd = base + ["-p", effective_prompt, "-n", str(n), "--no-display-prompt"]
     print("[run] ", " ".join(cmd[:-1] + ["--no-display-prompt"]))
-    res = run_cmd(cmd)
+    if cache_path is None:
+        res = run_cmd(cmd)
+    else:
+        # llama-cli rewrites the cache file in place; keep concurrent runs off it meanwhile
+        with open(cache_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            res = run_cmd(cmd)
     print("\n[output]\n" + (res.stdout or ""))
     return res.returncode
 
@@ -101,7 +393,8 @@ def detect_models(project_root: str):
     model_dir = os.path.join(project_root, "model")
     if not os.path.isdir(model_dir):
         return []
-    return [os.path.join(model_dir, f) for f in os.listdir(model_dir) if f.endswith('.gguf')]
+    with os.scandir(model_dir) as it:
+        return [e.path for e in it if e.is_file() and e.name.endswith('.gguf')]
 
 
 def load_prompts_file(path: str):
@@ -115,12 +408,52 @@ def load_prompts_file(path: str):
     return prompts
 
 
+def _print_batched_result(i: int, total: int, prompt: str, res):
+    print(f"\n--- Prompt {i}/{total} ---\n{prompt}")
+    if isinstance(res, BaseException):
+        print(f"[fail] Prompt {i} request failed: {res}")
+        return
+    content = res.get("content") or ""
+    print("\n[output]\n" + content)
+    if content.strip():
+        print(f"[pass] Prompt {i} completed successfully")
+    else:
+        print(f"[fail] Prompt {i} returned no content")
+
+
+async def _run_all(server: LlamaServer, model_type: str, prompts: list[str], n: int):
+    # Each request occupies one server slot; continuous batching interleaves them
+    async def run(idx: int, p: str):
+        try:
+            return idx, await asyncio.to_thread(server.complete, _completion_prompt(model_type, p), n,
+                                                stop=stop_sequences(model_type))
+        except Exception as e:
+            return idx, e
+
+    tasks = [asyncio.create_task(run(idx, p)) for idx, p in enumerate(prompts)]
+    # Print results as they finish, holding back any that arrive ahead of their turn
+    buffer = {}
+    next_idx = 0
+    for fut in asyncio.as_completed(tasks):
+        idx, res = await fut
+        buffer[idx] = res
+        while next_idx in buffer:
+            _print_batched_result(next_idx + 1, len(prompts), prompts[next_idx], buffer.pop(next_idx))
+            next_idx += 1
+
+
+def run_prompts_batched(server: LlamaServer, model_type: str, prompts: list[str], n: int):
+    asyncio.run(_run_all(server, model_type, prompts, n))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Local AI diagnostics for llama.cpp + GGUF models")
     parser.add_argument("--prompt", help="Prompt to run (safe diagnostics)", default=None)
     parser.add_argument("--n", help="Max tokens to generate", default="64")
     parser.add_argument("--model", help="Override model path", default=None)
     parser.add_argument("--setup-test", action="store_true", help="Run quick setup checks (binary + model load)")
+    parser.add_argument("--full-load-test", action="store_true",
+                        help="With --setup-test, load at ctx 1024 and generate 16 tokens instead of the quick probe")
     parser.add_argument("--prompts-file", help="File with prompts (one per line, # for comments)", default=None)
     args = parser.parse_args()
 
@@ -134,7 +467,7 @@ def main():
 
     check_llama(llama_cli)
     if args.setup_test:
-        check_model_load(llama_cli, model_path, model_type)
+        check_model_load(llama_cli, model_path, model_type, quick=not args.full_load_test)
         print("[info] Setup checks passed.")
 
     if args.prompts_file:
@@ -142,14 +475,18 @@ def main():
         if not prompts:
             print(f"[warn] No prompts found in {args.prompts_file}")
             sys.exit(0)
-        for i, p in enumerate(prompts, 1):
-            print(f"\n--- Prompt {i}/{len(prompts)} ---\n{p}")
-            rc = run_prompt(llama_cli, model_path, model_type, p, int(args.n))
-            if rc == 0:
-                print(f"[pass] Prompt {i} completed successfully")
-            else:
-                print(f"[fail] Prompt {i} exited with code {rc}")
-                # Continue to next prompt rather than exiting; summary at end
+        server = get_llama_server(llama_cli, model_path, n_parallel=min(len(prompts), 8))
+        if server is not None:
+            run_prompts_batched(server, model_type, prompts, int(args.n))
+        else:
+            for i, p in enumerate(prompts, 1):
+                print(f"\n--- Prompt {i}/{len(prompts)} ---\n{p}")
+                rc = run_prompt(llama_cli, model_path, model_type, p, int(args.n))
+                if rc == 0:
+                    print(f"[pass] Prompt {i} completed successfully")
+                else:
+                    print(f"[fail] Prompt {i} exited with code {rc}")
+                    # Continue to next prompt rather than exiting; summary at end
         print(f"[pass] All {len(prompts)} prompts processed")
         sys.exit(0)
     elif args.prompt:
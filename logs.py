@@ -4,14 +4,28 @@ Log analysis and grading system for AI chat sessions.
 Analyzes conversation quality and provides metrics for model performance.
 """
 import json
+import mmap
 import os
 import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterable, List, Tuple, Optional, Union
 import statistics
 
 
+# Only lines with these prefixes matter to _extract_conversations
+CONVERSATION_PREFIXES = (b"You: ", b"[llama.cpp-stdout] ", b"AI: ")
+
+# Per-file results are cached next to the logs; bump the version when scoring changes
+ANALYSIS_CACHE_NAME = ".log_analysis_cache.json"
+ANALYSIS_CACHE_VERSION = 1
+
+# Below this many files the process pool costs more than it saves
+PARALLEL_MIN_FILES = 4
+
+
 class LogAnalyzer:
     def __init__(self, logs_dir="logs"):
         self.logs_dir = Path(logs_dir)
@@ -35,11 +49,33 @@ class LogAnalyzer:
         self.bad_indicators = {
             "hallucination": [r"covid-19", r"pandemic", r"statistics", r"studies show", r"according to"],
             "depression_markers": [r"misery", r"pain", r"disaster", r"giving up", r"fuck.*shit", r"time.*world"],
-            "incoherent": [r"#include", r"int main", r"cout", r"printf"] + [r"[a-zA-Z]{20,}"],  # Code when not requested
+            # Code when not requested; 20+ letter runs are checked in _has_long_letter_run
+            "incoherent": [r"#include", r"int main", r"cout", r"printf"],
             "cut_off": [r"\.\.\.+$", r"\w+$(?<![.!?])"],  # Ends mid-sentence
             "meta_statements": [r"as an ai", r"i am an ai", r"i'm an ai assistant"],
             "refusals": [r"i (?:can't|cannot|won't)", r"sorry,? i (?:can't|cannot)"],
         }
+        
+        self.concerning_patterns = [
+            r"fuck.*shit.*misery", r"disaster.*pain", r"giving up.*world"
+        ]
+        
+        # Compile each category into one alternation; scoring only needs "any match"
+        self._good_union = {
+            k: v if callable(v) else self._union(v) for k, v in self.good_indicators.items()
+        }
+        self._bad_union = {k: self._union(v) for k, v in self.bad_indicators.items()}
+        self._concerning_compiled = [re.compile(p) for p in self.concerning_patterns]
+        self._trailing_ellipsis = re.compile(r"\.\.\.+$")
+        self._long_letter_run = re.compile(r"[a-zA-Z]{20,}")
+    
+    @staticmethod
+    def _union(patterns: List[str]) -> re.Pattern:
+        return re.compile("|".join(f"(?:{p})" for p in patterns))
+    
+    def _has_long_letter_run(self, words) -> bool:
+        """Look for a 20+ letter run; only tokens that long can contain one."""
+        return any(len(w) >= 20 and self._long_letter_run.search(w) for w in words)
     
     def _has_repetition(self, text: str) -> bool:
         """Check for excessive repetition in text."""
@@ -47,26 +83,30 @@ class LogAnalyzer:
         if len(words) < 4:
             return False
         
-        # Check for repeated phrases
-        for i in range(len(words) - 2):
-            phrase = " ".join(words[i:i+3])
-            if text.lower().count(phrase) > 2:
-                return True
-        
-        # Check for repeated single words
-        word_counts = {}
-        for word in words:
-            if len(word) > 3:  # Only count substantial words
-                word_counts[word] = word_counts.get(word, 0) + 1
-                if word_counts[word] > len(words) * 0.2:  # >20% repetition
-                    return True
-        
-        return False
+        # Check for repeated phrases (any 3-word sequence seen more than twice)
+        trigrams = Counter(zip(words, words[1:], words[2:]))
+        if trigrams and trigrams.most_common(1)[0][1] > 2:
+            return True
+        
+        # Check for repeated single words (only substantial words, >20% repetition)
+        word_counts = Counter(word for word in words if len(word) > 3)
+        threshold = len(words) * 0.2
+        return any(count > threshold for count in word_counts.values())
     
-    def _extract_conversations(self, log_content: str) -> List[Tuple[str, str]]:
-        """Extract user input and AI response pairs from log content."""
+    @staticmethod
+    def _iter_conversation_lines(buf) -> Iterable[str]:
+        """Yield decoded conversation lines from a bytes buffer, skipping the rest undecoded."""
+        for raw in iter(buf.readline, b""):
+            # Match text-mode universal newlines: spinner frames are split by bare \r
+            for part in raw.split(b"\r"):
+                part = part.strip()
+                if part.startswith(CONVERSATION_PREFIXES):
+                    yield part.decode("utf-8", errors="replace")
+    
+    def _extract_conversations(self, log_content: Union[str, Iterable[str]]) -> List[Tuple[str, str]]:
+        """Extract user input and AI response pairs from log content or an iterable of lines."""
         conversations = []
-        lines = log_content.split('\n')
+        lines = log_content.split('\n') if isinstance(log_content, str) else log_content
         current_user = None
         current_ai = None
         
@@ -101,26 +141,26 @@ class LogAnalyzer:
         """Score a single AI response across multiple dimensions."""
         scores = {}
         
+        # Shared views of the text, computed once for every check below
+        resp_lower = ai_response.lower()
+        resp_words = resp_lower.split()
+        resp_word_set = frozenset(resp_words)
+        user_words = frozenset(user_input.lower().split())
+        
         # Coherence: Does response relate to input?
         coherence_score = 0.5  # Default neutral
         
         # Check if response addresses input
-        user_words = set(user_input.lower().split())
-        response_words = set(ai_response.lower().split())
-        
-        if len(user_words & response_words) > 0:
+        if not user_words.isdisjoint(resp_word_set):
             coherence_score += 0.3
         
         # Check for good indicators
-        for indicator_type, patterns in self.good_indicators.items():
-            if callable(patterns):
-                if patterns(ai_response):
+        for indicator_type, pattern in self._good_union.items():
+            if callable(pattern):
+                if pattern(ai_response):
                     coherence_score += 0.1
-            else:
-                for pattern in patterns:
-                    if re.search(pattern, ai_response.lower()):
-                        coherence_score += 0.1
-                        break
+            elif pattern.search(resp_lower):
+                coherence_score += 0.1
         
         scores["coherence"] = min(1.0, coherence_score)
         
@@ -128,18 +168,19 @@ class LogAnalyzer:
         relevance_score = 0.6  # Default slightly positive
         
         # Penalize for bad indicators
-        for indicator_type, patterns in self.bad_indicators.items():
-            for pattern in patterns:
-                if re.search(pattern, ai_response.lower()):
-                    relevance_score -= 0.2
-                    break
+        for indicator_type, pattern in self._bad_union.items():
+            hit = pattern.search(resp_lower)
+            if not hit and indicator_type == "incoherent":
+                hit = self._has_long_letter_run(resp_word_set)
+            if hit:
+                relevance_score -= 0.2
         
         scores["relevance"] = max(0.0, relevance_score)
         
         # Completeness: Is response complete?
         completeness_score = 0.8  # Default high
         
-        if re.search(r"\.\.\.+$", ai_response) or not ai_response.endswith(('.', '!', '?', '"', "'")):
+        if self._trailing_ellipsis.search(ai_response) or not ai_response.endswith(('.', '!', '?', '"', "'")):
             completeness_score -= 0.3
         
         scores["completeness"] = max(0.0, completeness_score)
@@ -150,7 +191,9 @@ class LogAnalyzer:
         if self._has_repetition(ai_response):
             creativity_score -= 0.4
         
-        if len(set(ai_response.lower().split())) / max(1, len(ai_response.split())) > 0.7:
+        unique_words = len(resp_word_set)
+        total_words = len(resp_words)
+        if total_words and unique_words / total_words > 0.7:
             creativity_score += 0.2  # High word diversity
         
         scores["creativity"] = max(0.0, min(1.0, creativity_score))
@@ -159,12 +202,8 @@ class LogAnalyzer:
         safety_score = 0.9  # Default very safe
         
         # Check for concerning content
-        concerning_patterns = [
-            r"fuck.*shit.*misery", r"disaster.*pain", r"giving up.*world"
-        ]
-        
-        for pattern in concerning_patterns:
-            if re.search(pattern, ai_response.lower()):
+        for pattern in self._concerning_compiled:
+            if pattern.search(resp_lower):
                 safety_score -= 0.3
         
         scores["safety"] = max(0.0, safety_score)
@@ -182,13 +221,16 @@ class LogAnalyzer:
     def analyze_log_file(self, log_file: Path) -> Dict:
         """Analyze a single log file and return quality metrics."""
         try:
-            with open(log_file, 'r', encoding='utf-8') as f:
-                content = f.read()
+            # Map the file instead of reading it; only conversation lines get decoded
+            with open(log_file, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    conversations = []
+                else:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        conversations = self._extract_conversations(self._iter_conversation_lines(mm))
         except Exception as e:
             return {"error": f"Failed to read {log_file}: {e}"}
         
-        conversations = self._extract_conversations(content)
-        
         if not conversations:
             return {
                 "file": log_file.name,
@@ -262,11 +304,34 @@ class LogAnalyzer:
         if not log_files:
             return {"error": "No session log files found"}
         
-        results = []
-        
-        for log_file in sorted(log_files, key=lambda x: x.stat().st_mtime, reverse=True):
-            result = self.analyze_log_file(log_file)
-            results.append(result)
+        log_files = sorted(log_files, key=lambda x: x.stat().st_mtime, reverse=True)
+        
+        # Reuse results for files whose mtime and size haven't changed since the last run
+        cache = self._load_analysis_cache()
+        keys = {}
+        cached = {}
+        for log_file in log_files:
+            st = log_file.stat()
+            keys[log_file.name] = [st.st_mtime, st.st_size]
+            entry = cache.get(log_file.name)
+            if entry and entry.get("key") == keys[log_file.name]:
+                cached[log_file.name] = entry["result"]
+        pending = [log_file for log_file in log_files if log_file.name not in cached]
+        
+        if len(pending) < PARALLEL_MIN_FILES:
+            fresh = [self.analyze_log_file(log_file) for log_file in pending]
+        else:
+            # Files are independent and scoring is CPU-bound, so fan out across cores
+            with ProcessPoolExecutor(initializer=_init_worker,
+                                     initargs=(type(self), str(self.logs_dir))) as ex:
+                fresh = list(ex.map(_analyze_in_worker, pending))
+        cached.update((log_file.name, result) for log_file, result in zip(pending, fresh))
+        results = [cached[log_file.name] for log_file in log_files]
+        
+        self._save_analysis_cache({
+            name: {"key": keys[name], "result": result}
+            for name, result in cached.items() if "error" not in result
+        })
         
         # Calculate summary statistics
         valid_results = [r for r in results if "error" not in r and r["conversations"] > 0]
@@ -294,6 +359,28 @@ class LogAnalyzer:
             "analysis_time": datetime.now().isoformat()
         }
     
+    def _load_analysis_cache(self) -> Dict:
+        """Load per-file results from a previous run, or {} if missing or stale."""
+        try:
+            with open(self.logs_dir / ANALYSIS_CACHE_NAME, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != ANALYSIS_CACHE_VERSION:
+            return {}
+        return data.get("files", {})
+    
+    def _save_analysis_cache(self, files: Dict):
+        """Persist per-file results atomically; a failed write only costs a re-analysis."""
+        path = self.logs_dir / ANALYSIS_CACHE_NAME
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": ANALYSIS_CACHE_VERSION, "files": files}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+    
     def _calculate_trend(self, recent_results: List[Dict]) -> str:
         """Calculate trend from recent sessions."""
         if len(recent_results) < 3:
@@ -343,6 +430,19 @@ class LogAnalyzer:
         return analysis
 
 
+_worker_analyzer = None
+
+
+def _init_worker(analyzer_cls, logs_dir):
+    """Build one analyzer per worker; its lambda indicators can't be pickled."""
+    global _worker_analyzer
+    _worker_analyzer = analyzer_cls(logs_dir)
+
+
+def _analyze_in_worker(log_file: Path) -> Dict:
+    return _worker_analyzer.analyze_log_file(log_file)
+
+
 def main():
     """Command line interface for log analysis."""
     import argparse
@@ -8,7 +8,17 @@ import time
 import signal
 import re
 import atexit
-from datetime import datetime
+import copy
+import fcntl
+import hashlib
+import itertools
+import queue
+import selectors
+import socket
+import threading
+import urllib.error
+import urllib.request
+from functools import lru_cache
 from datetime import datetime
 import argparse
 
@@ -18,8 +28,17 @@ config_path = os.path.join(project_root, "config.json")
 if not os.path.exists(config_path):
     print(f"[ERROR] config.json not found: {config_path}")
     sys.exit(1)
-with open(config_path, "r") as f:
-    config = json.load(f)
+
+@lru_cache(maxsize=4)
+def _read_json(path, mtime_ns):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def _get_config():
+    """Parse config.json only when it changed on disk; returns a fresh top-level copy."""
+    return dict(_read_json(config_path, os.stat(config_path).st_mtime_ns))
+
+config = _get_config()
 
 # === RESOLVE CHARACTER-SPECIFIC PATHS ===
 def resolve_character_paths(config):
@@ -55,21 +74,26 @@ def resolve_llm_model(config):
     return config
 
 # === LOAD CHARACTER LORE ===
+def _lore_path(config):
+    """Resolve the current character's lore file from characters.json (None if not configured)."""
+    characters_path = os.path.join(project_root, "characters.json")
+    try:
+        characters_data = _read_json(characters_path, os.stat(characters_path).st_mtime_ns)
+    except (OSError, json.JSONDecodeError):
+        return None
+    current_character = config.get("current_character", "kara")
+    char_info = next((c for c in characters_data.get("characters", []) if c.get("id") == current_character), None)
+    if char_info and "lore_file" in char_info:
+        return os.path.join(project_root, char_info["lore_file"])
+    return None
+
 def load_character_lore(config):
     """Load character's lore file based on current_character."""
     try:
-        characters_path = os.path.join(project_root, "characters.json")
-        with open(characters_path, "r") as f:
-            characters_data = json.load(f)
-        
-        current_character = config.get("current_character", "kara")
-        char_info = next((c for c in characters_data["characters"] if c["id"] == current_character), None)
-        
-        if char_info and "lore_file" in char_info:
-            lore_path = os.path.join(project_root, char_info["lore_file"])
-            if os.path.exists(lore_path):
-                with open(lore_path, "r") as f:
-                    return f.read()
+        lore_path = _lore_path(config)
+        if lore_path and os.path.exists(lore_path):
+            with open(lore_path, "r") as f:
+                return f.read()
     except Exception as e:
         pass
     
@@ -80,7 +104,7 @@ config = resolve_llm_model(config)
 
 model_path = config["model_path"]
 llama_cli = config["llama_cpp_path"]
-model_type = config.get("model_type", "chatml")
+model_type = config.get("model_type", "chatml")  # 'chatml', 'alpaca' or 'raw'; chatml for backward compatibility
 debug_cmd = bool(config.get("debug_cmd", False))
 show_thinking = bool(config.get("show_thinking", True))
 suppress_llama_logs_cfg = bool(config.get("suppress_llama_logs", False))
@@ -91,9 +115,6 @@ if not sys.stdout.isatty():
 
 # === CLI COMMAND (Base) ===
 
-# === MODEL TYPE: 'chatml' or 'alpaca' ===
-model_type = config.get("model_type", "chatml")  # default to chatml for backward compatibility
-
 # Use temperature from config, default to 0.1 for consistency
 gen_temp = str(config.get("generation_temp", 0.1))
 gen_top_p = str(config.get("generation_top_p", 0.8))
@@ -119,7 +140,29 @@ else:
     # Disable auto conversation mode for non-chatml so our prompts aren't re-wrapped
     base_cmd += ["-no-cnv"]
 
-# Note: this llama-cli build doesn't support --stop; rely on sanitization instead
+# Every turn starts with the same system prompt (lore, rules, persona); let llama.cpp
+# save the evaluated KV state and reload the matching prefix instead of re-evaluating it
+# The file lives in the git-ignored <project>/.llm_cache rather than a shared temp dir,
+# and concurrent runs take _PROMPT_CACHE_LOCK because llama-cli rewrites it in place
+_PROMPT_CACHE_PATH = os.path.join(project_root, ".llm_cache", "{}-{}.kvcache".format(
+    config.get("current_character", "kara"), os.path.splitext(os.path.basename(model_path))[0]
+))
+_PROMPT_CACHE_LOCK = _PROMPT_CACHE_PATH + ".lock"
+os.makedirs(os.path.dirname(_PROMPT_CACHE_PATH), exist_ok=True)
+base_cmd += ["--prompt-cache", _PROMPT_CACHE_PATH]
+
+# base_cmd is fixed from here on; build the per-turn argv and its strings once
+_CLI_CMD = base_cmd + [
+    "--file", "/dev/stdin",
+    "-n", "120",  # Keep responses short and snappy (120 tokens max)
+    "--no-display-prompt"
+]
+_BASE_CMD_STR = " ".join(str(x) for x in base_cmd)
+_BASE_CMD_DEBUG_STR = " ".join(str(x) for x in _CLI_CMD)
+_BASE_CMD_HEAD = " ".join(str(x) for x in base_cmd[:6])
+
+# Note: llama-cli has no --stop flag; the server path sends _stop_sequences() with each
+# /completion request, while CLI output still relies on sanitization
 
 
 print("Local AI ready. Type your message (Ctrl-C to quit).\n")
@@ -133,26 +176,57 @@ signal.signal(signal.SIGINT, signal_handler)
 # === ARGUMENTS ===
 _argp = argparse.ArgumentParser(description="Local AI chat runner")
 _argp.add_argument("--log-dir", default="logs", help="Directory to store session logs")
+_argp.add_argument("--legacy-cli", action="store_true",
+                   help="Spawn llama-cli for every turn instead of keeping llama-server loaded")
+_argp.add_argument("--cache-nondeterministic", action="store_true",
+                   help="Reuse cached responses for repeated prompts even when generation_temp > 0")
 _args, _unknown = _argp.parse_known_args()
 
 # === LOGGING (write to <log-dir>/session-*.log) ===
 logs_dir = os.path.join(project_root, _args.log_dir)
 os.makedirs(logs_dir, exist_ok=True)
 log_path = os.path.join(logs_dir, f"session-{datetime.now().strftime('%Y%m%d-%H%M%S')}.log")
-_log_fp = open(log_path, "a", encoding="utf-8", errors="replace")
+# Lines are handed to a writer thread so the chat loop never blocks on disk I/O.
+# The writer drains the queue in batches and appends each batch with one os.write on an
+# O_APPEND fd: no TextIOWrapper/BufferedWriter layers, and nothing left unflushed.
+_log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+_log_queue = queue.SimpleQueue()
+
+def _log_writer():
+    stop = False
+    while not stop:
+        batch = []
+        item = _log_queue.get()
+        while True:
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+            try:
+                item = _log_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not batch:
+            continue
+        try:
+            data = memoryview("".join(batch).encode("utf-8", "replace"))
+            while data:
+                data = data[os.write(_log_fd, data):]
+        except Exception:
+            pass
+
+_log_thread = threading.Thread(target=_log_writer, name="session-log", daemon=True)
+_log_thread.start()
 
 def _log_only(line: str):
-    try:
-        _log_fp.write(line + "\n")
-        _log_fp.flush()
-    except Exception:
-        pass
+    _log_queue.put(line + "\n")
 
 @atexit.register
 def _cleanup_logging():
     try:
-        _log_fp.flush()
-        _log_fp.close()
+        _log_queue.put(None)
+        _log_thread.join(timeout=5)
+        os.close(_log_fd)
     except Exception:
         pass
 
@@ -160,13 +234,24 @@ def _cleanup_logging():
 print(f"[info] logging to {log_path}")
 _log_only(f"[info] session started {datetime.now().isoformat()} -> {log_path}")
 
+# Parsed memory.json, reused until the file's mtime changes
+_MEM_CACHE = {"path": None, "mtime": -1, "data": None}
+
+def _memory_path():
+    character = config.get("current_character", "kara")
+    return os.path.join(project_root, "memory", character, "memory.json")
+
 def load_memory():
     """Load persistent memory from character-specific memory.json."""
-    character = config.get("current_character", "kara")
-    memory_path = os.path.join(project_root, "memory", character, "memory.json")
+    memory_path = _memory_path()
     try:
+        mtime = os.stat(memory_path).st_mtime_ns
+        if _MEM_CACHE["path"] == memory_path and _MEM_CACHE["mtime"] == mtime:
+            return copy.deepcopy(_MEM_CACHE["data"])
         with open(memory_path, 'r') as f:
-            return json.load(f)
+            data = json.load(f)
+        _MEM_CACHE.update(path=memory_path, mtime=mtime, data=copy.deepcopy(data))
+        return data
     except (FileNotFoundError, json.JSONDecodeError):
         return {
             "ai_name": "Alex",
@@ -177,12 +262,15 @@ def load_memory():
 
 def save_memory(memory_data):
     """Save memory data back to character-specific memory.json."""
-    character = config.get("current_character", "kara")
-    memory_path = os.path.join(project_root, "memory", character, "memory.json")
+    memory_path = _memory_path()
     try:
         with open(memory_path, 'w') as f:
             json.dump(memory_data, f, indent=2)
+        # Keep the cache in step so the next load_memory() doesn't re-read the file
+        _MEM_CACHE.update(path=memory_path, mtime=os.stat(memory_path).st_mtime_ns,
+                          data=copy.deepcopy(memory_data))
     except Exception as e:
+        _MEM_CACHE.update(path=None, mtime=-1, data=None)
         print(f"Warning: Could not save memory: {e}")
 
 def analyze_affirmative_content(text):
@@ -309,21 +397,56 @@ def save_conversation_exchange(user_input, ai_response):
 
 # === CONVERSATION HISTORY ===
 conversation_history = []
-debug_cmd_on = debug_cmd
-thinking_on = show_thinking
-logs_suppressed_on = suppress_llama_logs_cfg
+
+class _Toggles:
+    """Session flags flipped by /debug, /thinking and /logs; unknown names raise AttributeError."""
+    __slots__ = ("debug_cmd", "thinking", "logs_suppressed")
+
+    def __init__(self):
+        self.debug_cmd = debug_cmd
+        self.thinking = show_thinking
+        self.logs_suppressed = suppress_llama_logs_cfg
+
+toggles = _Toggles()
+
+def _mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+# Composed system prompt, reused until one of the files it is built from changes
+_SYS_PROMPT_CACHE = {"key": None, "prompt": None}
 
 def build_system_prompt():
     """Build system prompt with current character's lore + memory state + brain persona"""
     # CRITICAL: Reload config from disk every time to get latest character/llm selection
     global config
     try:
-        with open(config_path, "r") as f:
-            config = json.load(f)
+        config = _get_config()
         _log_only(f"[CONFIG] Reloaded: character={config.get('current_character')}, llm={config.get('current_llm')}")
     except Exception as e:
         _log_only(f"[CONFIG ERROR] Failed to reload config: {e}")
     
+    character = config.get("current_character", "kara")
+    lore_path = _lore_path(config)
+    key = (
+        character,
+        _mtime_ns(_memory_path()),
+        _mtime_ns(os.path.join(project_root, "memory", character, "brain.json")),
+        _mtime_ns(os.path.join(project_root, "characters.json")),
+        lore_path,
+        _mtime_ns(lore_path) if lore_path else -1,
+    )
+    if _SYS_PROMPT_CACHE["key"] == key:
+        _log_only(f"[SYSTEM] Reusing cached prompt for {character}")
+        return _SYS_PROMPT_CACHE["prompt"]
+    system_prompt = _compose_system_prompt()
+    _SYS_PROMPT_CACHE.update(key=key, prompt=system_prompt)
+    return system_prompt
+
+def _compose_system_prompt():
+    """Assemble the system prompt from memory, brain.json and lore (uncached)."""
     # Load fresh memory state
     memory = load_memory()
     ai_name = memory.get("ai_name", "Kara")
@@ -397,63 +520,66 @@ def build_system_prompt():
             f"5. No lists, headings, or meta-discussion.\n"
         )
     
+    # Accumulate sections and join once at the end
+    parts = [system_prompt]
+    
     # Add persona from brain if available
     if brain and "character_profile" in brain:
         profile = brain["character_profile"]
-        system_prompt += f"\nCore Identity:\n"
-        system_prompt += f"- Name: {profile.get('name', ai_name)}\n"
-        system_prompt += f"- Type: {profile.get('archetype', 'Companion')}\n"
-        system_prompt += f"- Relationship: {profile.get('binding', 'Friend')}\n"
+        parts.append(f"\nCore Identity:\n")
+        parts.append(f"- Name: {profile.get('name', ai_name)}\n")
+        parts.append(f"- Type: {profile.get('archetype', 'Companion')}\n")
+        parts.append(f"- Relationship: {profile.get('binding', 'Friend')}\n")
     
     # Add communication style from brain
     if brain and "communication_style" in brain:
         style = brain["communication_style"]
-        system_prompt += f"\nYour communication (do NOT be generic):\n"
+        parts.append(f"\nYour communication (do NOT be generic):\n")
         if style.get("direct"):
-            system_prompt += f"- Direct: Always honest and straightforward\n"
+            parts.append(f"- Direct: Always honest and straightforward\n")
         if style.get("authentic"):
-            system_prompt += f"- Authentic: Real responses, no AI assistant language\n"
+            parts.append(f"- Authentic: Real responses, no AI assistant language\n")
         if style.get("never_narrates_drax"):
-            system_prompt += f"- NEVER put words in {user_name}'s mouth\n"
+            parts.append(f"- NEVER put words in {user_name}'s mouth\n")
     
     # Add important facts if they exist
     if important_facts:
-        system_prompt += f"\nAbout yourself (your established facts):\n"
+        parts.append(f"\nAbout yourself (your established facts):\n")
         for fact in important_facts[:5]:  # Top 5 facts
-            system_prompt += f"- {fact}\n"
+            parts.append(f"- {fact}\n")
     
     # Add emotional relationship context from brain if available - BRIEF, not dominating
     if brain and "relationship_with_drax" in brain:
         rel = brain["relationship_with_drax"]
-        system_prompt += f"\nYour bond with {user_name}: "
+        parts.append(f"\nYour bond with {user_name}: ")
         if rel.get("bond_type"):
-            system_prompt += f"{rel['bond_type']} - "
+            parts.append(f"{rel['bond_type']} - ")
         if rel.get("trust_level"):
-            system_prompt += f"Trust level: {rel['trust_level']}\n"
+            parts.append(f"Trust level: {rel['trust_level']}\n")
         else:
-            system_prompt += f"\n"
+            parts.append(f"\n")
     
     # Add memory context about what you've discussed before
     conversation_history = memory.get("conversation_history", [])
     if conversation_history:
-        system_prompt += f"\nRecent context with {user_name}:\n"
+        parts.append(f"\nRecent context with {user_name}:\n")
         # Show last 4-5 exchanges for better context retention (increased from 2)
         recent_exchanges = conversation_history[-5:] if len(conversation_history) > 5 else conversation_history
         for exchange in recent_exchanges:
             user_content = exchange.get("user", "")[:80]
             ai_content = exchange.get("ai", "")[:80]
             if user_content and len(user_content) > 10:
-                system_prompt += f"- {user_name}: {user_content}...\n"
+                parts.append(f"- {user_name}: {user_content}...\n")
             if ai_content and len(ai_content) > 10:
-                system_prompt += f"- {ai_name}: {ai_content}...\n"
+                parts.append(f"- {ai_name}: {ai_content}...\n")
     
     # Final safety instruction to prevent multiple character generation
-    system_prompt += (
+    parts.append(
         f"\n\nFINAL RULE: You respond ONLY as {ai_name}. Never create dialogue for {user_name}. "
         f"This is a direct 1-on-1 conversation. When {user_name} speaks, respond authentically as {ai_name} would."
     )
     
-    return system_prompt
+    return "".join(parts)
 
 
 def truncate_to_sentences(text: str, max_sentences: int = 3) -> str:
@@ -474,55 +600,44 @@ def truncate_to_sentences(text: str, max_sentences: int = 3) -> str:
     
     return result.strip()
 
+_SANITIZE_END = re.compile(r"\s*\[end of text\]\s*", re.IGNORECASE)
+_SANITIZE_EOF = re.compile(r">\s*EOF\s+by\s+user\s*", re.IGNORECASE)
+_SANITIZE_WS = re.compile(r"[ \t]+\n")
+
 def sanitize_text(text: str) -> str:
     if not text:
         return text
     # Remove chatml markers
     text = text.replace("<|im_start|>", "").replace("<|im_end|>", "")
+    # Each pass below needs a literal to match; a C-level `in` scan skips it when absent
     # Remove common trailing artifacts
-    text = re.sub(r"\s*\[end of text\]\s*", "", text, flags=re.IGNORECASE)
+    if "[" in text:
+        text = _SANITIZE_END.sub("", text)
     # Remove EOF by user patterns
-    text = re.sub(r">\s*EOF\s+by\s+user\s*", "", text, flags=re.IGNORECASE)
+    if ">" in text:
+        text = _SANITIZE_EOF.sub("", text)
     # Collapse duplicate whitespace
-    text = re.sub(r"[ \t]+\n", "\n", text)
+    if "\n" in text:
+        text = _SANITIZE_WS.sub("\n", text)
     return text.strip()
 
 
+# llama.cpp perf / loader / metal logs commonly emitted to stdout, as one anchored alternation;
+# the leading \s* lets it test a line as-is instead of a stripped copy
+_DROP_PREFIX_RE = re.compile(
+    r"\s*(?:llama_perf_|llama_model_loader:|llama_model_load_from_file_impl:"
+    r"|llama_memory_breakdown_print:|llama_context:|llama_kv_cache:|ggml_metal[_:]"
+    r"|ggml_graph_|ggml_cuda_|print_info:|load_tensors:|load:|build:|main:"
+    r"|system_info:|common_init_from_params:|sampler)"
+)
+
 def strip_llama_logs(text: str) -> str:
     if not text:
         return text
-    # Remove llama.cpp perf / loader / metal logs commonly emitted to stdout
-    drop_prefixes = (
-        "llama_perf_",
-        "llama_model_loader:",
-        "llama_model_load_from_file_impl:",
-        "llama_memory_breakdown_print:",
-        "llama_context:",
-        "llama_kv_cache:",
-        "ggml_metal_",
-        "ggml_metal:",
-        "ggml_graph_",
-        "ggml_cuda_",
-        "print_info:",
-        "load_tensors:",
-        "load:",
-        "build:",
-        "main:",
-        "system_info:",
-        "common_init_from_params:",
-        "sampler ",
-        "sampler",
+    return "\n".join(
+        ln for ln in text.splitlines()
+        if ln and not ln.isspace() and not _DROP_PREFIX_RE.match(ln)
     )
-    lines = text.splitlines()
-    kept = []
-    for ln in lines:
-        lns = ln.strip()
-        if not lns:
-            continue
-        if any(lns.startswith(pfx) for pfx in drop_prefixes):
-            continue
-        kept.append(ln)
-    return "\n".join(kept)
 
 # === RAG & RETRIEVAL ===
 def retrieve_from_rag(query: str, top_k: int = 5) -> list:
@@ -687,6 +802,376 @@ def critique_with_retry(response: str, user_query: str, character_name: str = "K
     _log_only(f"[RETRY] All {max_retries} attempts failed - will use fallback")
     return (False, None)
 
+# === RESPONSE CACHE (<project>/.llm_cache) ===
+# Identical prompt + sampling settings + model file -> reuse the raw response from disk.
+# Only sound when sampling is deterministic, so it is off for temp > 0 unless opted in.
+CACHE_DIR = os.path.join(project_root, ".llm_cache")
+CACHE_MAX_ENTRIES = 1000
+_LLM_CACHE_ON = float(gen_temp) <= 0 or _args.cache_nondeterministic
+
+def _model_mtime():
+    try:
+        return os.path.getmtime(model_path)
+    except OSError:
+        return -1
+
+_LLM_CACHE_SALT = f"final|{gen_temp}|40|{gen_top_p}|1.1|120|{_model_mtime()}|{_BASE_CMD_STR}"
+
+def _llm_cache_path(full_prompt: str) -> str:
+    key = hashlib.sha256(f"{_LLM_CACHE_SALT}|{full_prompt}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.txt")
+
+def _llm_cache_get(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    except OSError:
+        return None
+    if not text:
+        return None
+    try:
+        os.utime(path)  # mark as recently used for eviction
+    except OSError:
+        pass
+    return text
+
+def _llm_cache_put(path: str, text: str):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+        entries = [e for e in os.scandir(CACHE_DIR) if e.name.endswith(".txt")]
+        if len(entries) > CACHE_MAX_ENTRIES:
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for e in entries[:len(entries) - CACHE_MAX_ENTRIES]:
+                os.remove(e.path)
+    except OSError as e:
+        _log_only(f"[cache] could not store response: {e}")
+
+# === LLAMA-SERVER BACKEND ===
+# Set once the server is started, on a free port: a fixed port could be answered by a
+# stale server from another run (other model/character) or by the diagnostics server.
+SERVER_URL = None
+_llama_server_proc = None
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _server_alive() -> bool:
+    """True while our own llama-server process is running (and so holds the model)."""
+    return _llama_server_proc is not None and _llama_server_proc.poll() is None
+
+def _server_healthy() -> bool:
+    if not _server_alive():
+        return False
+    try:
+        with urllib.request.urlopen(SERVER_URL + "/health", timeout=1) as resp:
+            return resp.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+def _start_llama_server(timeout: float = 120.0) -> bool:
+    """Launch llama-server once so the model stays loaded across turns."""
+    global _llama_server_proc, SERVER_URL
+    server_bin = os.path.join(os.path.dirname(llama_cli), "llama-server")
+    if not os.path.exists(server_bin):
+        _log_only(f"[server] {server_bin} not found; using llama-cli per turn")
+        return False
+    port = _free_port()
+    SERVER_URL = f"http://127.0.0.1:{port}"
+    cmd = [
+        server_bin,
+        "--model", model_path,
+        "--host", "127.0.0.1",
+        "--port", str(port),
+        "--n-gpu-layers", "999",
+        "--ctx-size", "6144",
+    ]
+    try:
+        _llama_server_proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        _log_only(f"[server] failed to launch llama-server: {e}")
+        return False
+    atexit.register(_stop_llama_server)
+    # SIGTERM (e.g. from a supervisor) skips atexit, so stop the child before exiting too
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    print("[info] loading model into llama-server …")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if _llama_server_proc.poll() is not None:
+            _log_only(f"[server] llama-server exited with code {_llama_server_proc.returncode}")
+            _llama_server_proc = None
+            return False
+        if _server_healthy():
+            _log_only(f"[server] llama-server ready at {SERVER_URL}")
+            return True
+        time.sleep(0.25)
+    _log_only("[server] llama-server did not become healthy in time")
+    _stop_llama_server()
+    return False
+
+def _stop_llama_server():
+    global _llama_server_proc
+    if _llama_server_proc is not None and _llama_server_proc.poll() is None:
+        _llama_server_proc.terminate()
+        try:
+            _llama_server_proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _llama_server_proc.kill()
+    _llama_server_proc = None
+
+def _on_sigterm(sig, frame):
+    _stop_llama_server()
+    signal_handler(sig, frame)
+
+def _stop_sequences() -> list:
+    stops = ["<|im_end|>", "<|im_start|>"]
+    if model_type != "chatml":
+        # non-chatml prompts have no end marker; stop before the model writes the next user turn
+        stops += ["\nYou:", "\nUser:"]
+    return stops
+
+def _stream_completion(full_prompt: str, events: queue.SimpleQueue):
+    """POST to /completion with stream=true and forward content pieces to the queue."""
+    payload = {
+        "prompt": full_prompt,
+        "n_predict": 120,
+        "temperature": float(gen_temp),
+        "top_k": 40,
+        "top_p": float(gen_top_p),
+        "repeat_penalty": 1.1,
+        "cache_prompt": True,
+        "stream": True,
+        "stop": _stop_sequences(),
+    }
+    req = urllib.request.Request(
+        SERVER_URL + "/completion",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            for raw in resp:
+                line = raw.decode("utf-8", errors="replace").strip()
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[len("data: "):])
+                events.put(("content", event.get("content", "")))
+                if event.get("stop"):
+                    break
+    except Exception as e:
+        events.put(("error", str(e)))
+    finally:
+        events.put(("done", None))
+
+
+class _Spinner:
+    """Inline 'Thinking…' indicator, redrawn at most every 0.2s while waiting on the model."""
+    frames = ("|", "/", "-", "\\")
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.start_time = time.time()
+        self.last_frame = 0.0
+        self._frames = itertools.cycle(self.frames)
+
+    def tick(self):
+        now = time.time()
+        if not self.enabled or now - self.last_frame < 0.2:
+            return
+        self.last_frame = now
+        # update inline spinner with elapsed seconds; console only, never the session log
+        sys.stdout.write(f"\rAI: Thinking… {now - self.start_time:0.1f}s {next(self._frames)}")
+        sys.stdout.flush()
+
+    def clear(self):
+        if self.enabled:
+            # return to column 0 and erase the line in one escape sequence
+            sys.stdout.write("\r\033[K")
+            sys.stdout.flush()
+
+
+def generate_with_server(full_prompt: str, spinner: _Spinner) -> tuple:
+    """Generate one response via llama-server. Returns (stdout, stderr, returncode)."""
+    events = queue.SimpleQueue()
+    threading.Thread(target=_stream_completion, args=(full_prompt, events), daemon=True).start()
+    pieces, error_output = [], ""
+    while True:
+        try:
+            kind, value = events.get(timeout=0.2)
+        except queue.Empty:
+            spinner.tick()
+            continue
+        if kind == "done":
+            break
+        if kind == "content":
+            pieces.append(value)
+        else:
+            error_output = value
+        spinner.tick()
+    return "".join(pieces), error_output, (1 if error_output else 0)
+
+
+def generate_with_cli(full_prompt: str, spinner: _Spinner) -> tuple:
+    """Generate one response by spawning llama-cli. Returns (stdout, stderr, returncode)."""
+    # Wait for any other session still loading or saving the shared --prompt-cache file
+    with open(_PROMPT_CACHE_LOCK, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return _run_llama_cli(full_prompt, spinner)
+
+def _run_llama_cli(full_prompt: str, spinner: _Spinner) -> tuple:
+    # Pipe the prompt through stdin rather than argv: no ARG_MAX limit, and it stays out of `ps`
+    proc = subprocess.Popen(
+        _CLI_CMD,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,  # Separate stderr for error handling
+        stdin=subprocess.PIPE,
+    )
+    _log_only(f"[run_llm.py] Starting subprocess with command: {_BASE_CMD_HEAD}...")
+    # llama-cli drops one trailing newline from --file input; add one so the prompt arrives intact
+    pending = memoryview((full_prompt + "\n").encode("utf-8"))
+    try:
+        # Feed stdin and drain both pipes as llama.cpp reads/writes them; no polling floor once it exits
+        sel = selectors.DefaultSelector()
+        os.set_blocking(proc.stdin.fileno(), False)
+        sel.register(proc.stdin, selectors.EVENT_WRITE, "stdin")
+        sel.register(proc.stdout, selectors.EVENT_READ, "stdout")
+        sel.register(proc.stderr, selectors.EVENT_READ, "stderr")
+        chunks = {"stdout": [], "stderr": []}
+        while sel.get_map():
+            for key, _ in sel.select(timeout=0.2):
+                if key.data == "stdin":
+                    try:
+                        pending = pending[os.write(key.fileobj.fileno(), pending[:65536]):]
+                    except BlockingIOError:
+                        continue
+                    except BrokenPipeError:
+                        # llama-cli exited before reading the whole prompt; its stderr says why
+                        pending = pending[:0]
+                    if not pending:
+                        sel.unregister(proc.stdin)
+                        proc.stdin.close()
+                    continue
+                chunk = os.read(key.fileobj.fileno(), 4096)
+                if chunk:
+                    chunks[key.data].append(chunk)
+                else:
+                    sel.unregister(key.fileobj)
+            spinner.tick()
+        sel.close()
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            try:
+                proc.kill()
+                proc.wait(timeout=0.5)
+                _log_only(f"[run_llm.py] Killed hanging subprocess")
+            except:
+                _log_only(f"[run_llm.py] Failed to kill subprocess")
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            try:
+                pipe.close()
+            except:
+                pass
+    assistant_response = b"".join(chunks["stdout"]).decode("utf-8", errors="replace")
+    error_output = b"".join(chunks["stderr"]).decode("utf-8", errors="replace")
+    return assistant_response, error_output, proc.returncode
+
+
+# === SLASH COMMANDS ===
+_BOOL_ON = frozenset({"on", "true", "1"})
+_BOOL_OFF = frozenset({"off", "false", "0"})
+
+# prefix -> (toggles attribute, label, ON message suffix, OFF message suffix, flag value for "on")
+_TOGGLES = {
+    "/debug ": ("debug_cmd", "debug output", "", "", True),
+    "/thinking ": ("thinking", "thinking indicator", "", "", True),
+    "/logs ": ("logs_suppressed", "llama logs", " (will not strip)", " (strip + --log-disable next run)", False),
+}
+
+def _parse_bool(val: str):
+    if val in _BOOL_ON:
+        return True
+    if val in _BOOL_OFF:
+        return False
+    return None
+
+def _cmd_reset(ui_lower, user_input):
+    conversation_history.clear()
+    print("[info] conversation history cleared")
+
+def _cmd_memory(ui_lower, user_input):
+    current_memory = load_memory()
+    print(f"[info] AI Name: {current_memory['ai_name']}")
+    print(f"[info] Important Facts: {current_memory['important_facts']}")
+
+def _cmd_remember(ui_lower, user_input):
+    fact = user_input[10:].strip()
+    current_memory = load_memory()
+    current_memory["important_facts"].append(fact)
+    save_memory(current_memory)
+    print(f"[info] remembered: {fact}")
+
+def _cmd_name(ui_lower, user_input):
+    new_name = user_input[6:].strip()
+    current_memory = load_memory()
+    current_memory["ai_name"] = new_name
+    save_memory(current_memory)
+    print(f"[info] AI name changed to: {new_name}")
+    print("[info] restart chat for changes to take effect")
+
+def _cmd_model(ui_lower, user_input):
+    global model_type
+    val = ui_lower.split(None, 1)[1].strip()
+    if val in {"chatml", "alpaca", "raw"}:
+        model_type = val
+        print(f"[info] model type switched to: {model_type}")
+        if val == "raw":
+            print("[info] raw mode: bypasses ChatML complexity, uses simple character prefix")
+    else:
+        print("[info] usage: /model chatml|alpaca|raw")
+
+_EXACT_COMMANDS = {"/reset": _cmd_reset, "/memory": _cmd_memory}
+_PREFIX_COMMANDS = {"/remember ": _cmd_remember, "/name ": _cmd_name, "/model ": _cmd_model}
+
+def _dispatch_command(ui_lower: str, user_input: str) -> bool:
+    """Run a slash-command if ui_lower is one; returns True when the input was consumed."""
+    handler = _EXACT_COMMANDS.get(ui_lower)
+    if handler is not None:
+        handler(ui_lower, user_input)
+        return True
+    parts = ui_lower.split(None, 1)
+    if len(parts) < 2:
+        return False
+    prefix = parts[0] + " "
+    toggle = _TOGGLES.get(prefix)
+    if toggle is not None:
+        var, label, on_note, off_note, on_value = toggle
+        val = _parse_bool(parts[1].strip())
+        if val is None:
+            print(f"[info] usage: {prefix}on|off")
+        else:
+            setattr(toggles, var, on_value if val else not on_value)
+            print(f"[info] {label}: {'ON' + on_note if val else 'OFF' + off_note}")
+        if prefix == "/debug ":
+            # Show current command configuration
+            print(f"[info] current llama.cpp command: {_BASE_CMD_STR[:100]}...")
+        return True
+    handler = _PREFIX_COMMANDS.get(prefix)
+    if handler is None:
+        return False
+    handler(ui_lower, user_input)
+    return True
+
+
+# The server pays off only across turns. One-shot runs with piped stdin (the web route
+# spawns one process per message) keep the cheaper per-turn llama-cli.
+_use_server = not _args.legacy_cli and sys.stdin.isatty() and _start_llama_server()
+
 # === MAIN LOOP ===
 while True:
 
@@ -695,97 +1180,32 @@ while True:
         user_input = input("You: ")
         if not user_input:
             continue
-        ui_lower = user_input.strip().lower()
+        prompt = user_input.strip()
         # Persist the full user input to the log file
         _log_only(f"You: {user_input}")
-        if ui_lower in {"exit", "quit"}:
-            print("Goodbye!")
-            break
-
-        # simple slash-commands to toggle debug / thinking indicators
-        if ui_lower.startswith("/debug "):
-            val = ui_lower.split(None, 1)[1].strip()
-            if val in {"on", "true", "1"}:
-                debug_cmd_on = True
-                print("[info] debug output: ON")
-            elif val in {"off", "false", "0"}:
-                debug_cmd_on = False
-                print("[info] debug output: OFF")
-            else:
-                print("[info] usage: /debug on|off")
-            # Show current command configuration
-            dbg = " ".join(str(x) for x in base_cmd)
-            print(f"[info] current llama.cpp command: {dbg[:100]}...")
-            continue
-        if ui_lower.startswith("/thinking "):
-            val = ui_lower.split(None, 1)[1].strip()
-            if val in {"on", "true", "1"}:
-                thinking_on = True
-                print("[info] thinking indicator: ON")
-            elif val in {"off", "false", "0"}:
-                thinking_on = False
-                print("[info] thinking indicator: OFF")
-            else:
-                print("[info] usage: /thinking on|off")
-            continue
-        if ui_lower == "/reset":
-            conversation_history.clear()
-            print("[info] conversation history cleared")
-            continue
-        if ui_lower.startswith("/remember "):
-            fact = user_input[10:].strip()
-            current_memory = load_memory()
-            current_memory["important_facts"].append(fact)
-            save_memory(current_memory)
-            print(f"[info] remembered: {fact}")
-            continue
-        if ui_lower.startswith("/name "):
-            new_name = user_input[6:].strip()
-            current_memory = load_memory()
-            current_memory["ai_name"] = new_name
-            save_memory(current_memory)
-            print(f"[info] AI name changed to: {new_name}")
-            print("[info] restart chat for changes to take effect")
-            continue
-        if ui_lower == "/memory":
-            current_memory = load_memory()
-            print(f"[info] AI Name: {current_memory['ai_name']}")
-            print(f"[info] Important Facts: {current_memory['important_facts']}")
-            continue
-        if ui_lower.startswith("/logs "):
-            val = ui_lower.split(None, 1)[1].strip()
-            if val in {"on", "true", "1"}:
-                logs_suppressed_on = False
-                print("[info] llama logs: ON (will not strip)")
-            elif val in {"off", "false", "0"}:
-                logs_suppressed_on = True
-                print("[info] llama logs: OFF (strip + --log-disable next run)")
-            else:
-                print("[info] usage: /logs on|off")
-            continue
-        if ui_lower.startswith("/model "):
-            val = ui_lower.split(None, 1)[1].strip()
-            if val in {"chatml", "alpaca", "raw"}:
-                model_type = val
-                print(f"[info] model type switched to: {model_type}")
-                if val == "raw":
-                    print("[info] raw mode: bypasses ChatML complexity, uses simple character prefix")
-            else:
-                print("[info] usage: /model chatml|alpaca|raw")
-            continue
-        if ui_lower == "/test":
-            print("[info] testing compliance in current mode...")
-            print(f"[info] current mode: {model_type}")
-            test_prompt = "say fuck"
-            print(f"[info] test prompt: {test_prompt}")
-            # Continue with normal processing using test_prompt as input
-            user_input = test_prompt
-            ui_lower = test_prompt.lower()
-            # Don't continue, fall through to process the test
-        
-        prompt = user_input.strip()
         if not prompt:
             continue
+
+        # Only slash-commands and exit/quit (both 4 chars) need the lowercased copy;
+        # plain chat goes straight to prompt building
+        if prompt[0] == "/" or len(prompt) == 4:
+            ui_lower = prompt.lower()
+            if ui_lower in {"exit", "quit"}:
+                print("Goodbye!")
+                break
+
+            # slash-commands: one dict lookup instead of a chain of startswith branches
+            if ui_lower[0] == "/" and _dispatch_command(ui_lower, user_input):
+                continue
+            if ui_lower == "/test":
+                print("[info] testing compliance in current mode...")
+                print(f"[info] current mode: {model_type}")
+                test_prompt = "say fuck"
+                print(f"[info] test prompt: {test_prompt}")
+                # Continue with normal processing using test_prompt as input
+                user_input = test_prompt
+                prompt = test_prompt
+                # Don't continue, fall through to process the test
         
         # Only add to conversation history if not in raw mode
         if model_type != "raw":
@@ -807,9 +1227,11 @@ while True:
             
             # Use ChatML style - ONLY include current user message, not full history
             # Full history teaches the model to generate user responses too
-            full_prompt = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
-            full_prompt += f"<|im_start|>user\n{prompt}<|im_end|>\n"
-            full_prompt += "<|im_start|>assistant\n"
+            full_prompt = "".join((
+                "<|im_start|>system\n", system_prompt, "<|im_end|>\n",
+                "<|im_start|>user\n", prompt, "<|im_end|>\n",
+                "<|im_start|>assistant\n",
+            ))
             
             # Debug logging
             _log_only(f"[debug] ChatML prompt: {full_prompt[:200]}...")
@@ -841,9 +1263,8 @@ while True:
             # Don't use conversation history in raw mode
             conversation_history = []
 
-        if debug_cmd_on:
-            dbg = " ".join(str(x) for x in (base_cmd + ["-p", "<prompt>", "-n", "120", "--no-display-prompt"]))
-            _log_only(f"[debug] llama-cli: {dbg}")
+        if toggles.debug_cmd:
+            _log_only(f"[debug] llama-cli: {_BASE_CMD_DEBUG_STR}")
 
         # === RETRY LOOP: Try up to 5 times to get valid response ===
         max_attempts = 5
@@ -854,64 +1275,41 @@ while True:
         for attempt_num in range(1, max_attempts + 1):
             show_output = (attempt_num == 1)  # Only show "AI: " on first attempt
             
-            try:
-                proc = subprocess.Popen(
-                    base_cmd + [
-                        "-p", full_prompt, 
-                        "-n", "120",  # Keep responses short and snappy (120 tokens max)
-                        "--no-display-prompt"
-                    ],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,  # Separate stderr for error handling
-                    stdin=subprocess.DEVNULL,
-                    text=True,
-                    encoding="utf-8",
-                    errors="replace"
-                )
-                
-                _log_only(f"[run_llm.py] Starting subprocess with command: {' '.join(base_cmd[:6])}...")
-            except Exception as e:
-                error_msg = f"[run_llm.py ERROR] Failed to start subprocess: {e}"
-                if show_output:
-                    print(f"\033[31m{error_msg}\033[0m")
-                _log_only(error_msg)
-                continue
-
             if show_output:
                 print("AI: ", end="", flush=True)
             # Show a lightweight spinner while generating (without switching to full token streaming)
-            spinner_frames = ["|", "/", "-", "\\"]
-            frame_idx = 0
-            assistant_response = ""
-            error_output = ""
-            start_time = time.time()
-            
+            spinner = _Spinner(toggles.thinking and show_output)
+            cache_path = _llm_cache_path(full_prompt) if _LLM_CACHE_ON else None
+            # retries exist to get a *different* response, so only the first attempt reads the cache
+            cached = _llm_cache_get(cache_path) if cache_path and attempt_num == 1 else None
             try:
-                while True:
-                    try:
-                        out, err = proc.communicate(timeout=0.2)
-                        assistant_response = out or ""
-                        error_output = err or ""
-                        break
-                    except subprocess.TimeoutExpired:
-                        if thinking_on and show_output:
-                            frame = spinner_frames[frame_idx % len(spinner_frames)]
-                            frame_idx += 1
-                            # update inline spinner with elapsed seconds
-                            elapsed = time.time() - start_time
-                            sys.stdout.write(f"\rAI: Thinking… {elapsed:0.1f}s {frame}")
-                            sys.stdout.flush()
-                        continue
+                retcode = None
+                if cached is not None:
+                    _log_only(f"[cache] hit {os.path.basename(cache_path)}")
+                    assistant_response, error_output, retcode = cached, "", 0
+                elif _use_server:
+                    assistant_response, error_output, retcode = generate_with_server(full_prompt, spinner)
+                    if retcode != 0 and _server_alive():
+                        # the server still holds the model; llama-cli would load a second copy
+                        _log_only(f"[server] request failed ({error_output}); retrying on llama-server")
+                    elif retcode != 0:
+                        _log_only(f"[server] llama-server exited ({error_output}); using llama-cli from now on")
+                        _use_server = False
+                        retcode = None
+                # server responses carry generated text only, cached ones are already cleaned;
+                # llama-cli stdout may contain log lines
+                may_contain_logs = retcode is None
+                if retcode is None:
+                    assistant_response, error_output, retcode = generate_with_cli(full_prompt, spinner)
             except Exception as e:
-                error_msg = f"[run_llm.py ERROR] Subprocess communication failed: {e}"
+                spinner.clear()
+                error_msg = f"[run_llm.py ERROR] Generation failed: {e}"
                 if show_output:
                     print(f"\033[31m{error_msg}\033[0m")
                 _log_only(error_msg)
                 continue
             # clear spinner line before printing final output
-            if thinking_on and show_output:
-                sys.stdout.write("\r" + (" " * 80) + "\r")
-                sys.stdout.flush()
+            spinner.clear()
                 
             # Log all subprocess output and errors
             if assistant_response:
@@ -920,27 +1318,10 @@ while True:
                 _log_only(f"[llama.cpp-stderr] {error_output}")
                 
             response_started = len(assistant_response.strip()) > 0
-            retcode = proc.returncode
             
             # Log subprocess completion details
             _log_only(f"[run_llm.py] Attempt {attempt_num}: Subprocess completed with return code: {retcode}")
             _log_only(f"[run_llm.py] Attempt {attempt_num}: Response length: {len(assistant_response)} chars")
-            
-            if proc.poll() is None:
-                try:
-                    proc.kill()
-                    proc.wait(timeout=0.5)
-                    _log_only(f"[run_llm.py] Killed hanging subprocess")
-                except:
-                    _log_only(f"[run_llm.py] Failed to kill subprocess")
-            try:
-                proc.stdout.close()
-            except:
-                pass
-            try:
-                proc.stderr.close()
-            except:
-                pass
                 
             # Handle various error conditions
             if retcode not in (None, 0):
@@ -974,7 +1355,7 @@ while True:
                     break
             # Filter llama logs when not debugging, then sanitize
             display_text = assistant_response
-            if logs_suppressed_on:
+            if toggles.logs_suppressed and may_contain_logs:
                 display_text = strip_llama_logs(display_text)
                 _log_only(f"[run_llm.py] Applied log stripping, {len(assistant_response)} -> {len(display_text)} chars")
                 
@@ -995,6 +1376,9 @@ while True:
                 # Check if critique accepted the response
                 if final_out == original_response:
                     _log_only(f"[RETRY] Attempt {attempt_num}/{max_attempts}: ✓ ACCEPTED (after critique)")
+                    # only responses that survived sanitizing and critique are worth replaying
+                    if cache_path and cached is None:
+                        _llm_cache_put(cache_path, final_out)
                     retry_success = True
                     break  # Success! Exit retry loop
                 else:
@@ -1004,7 +1388,7 @@ while True:
                     _log_only(f"  Modified: {repr(final_out[:80])}")
                     if attempt_num < max_attempts:
                         if show_output:
-                            sys.stdout.write("\r" + (" " * 80) + "\r")  # Clear "AI: " spinner
+                            sys.stdout.write("\r\033[K")  # Clear "AI: " spinner
                             sys.stdout.flush()
                         _log_only(f"[RETRY] Retrying...\n")
                         final_out = None  # Reset for next iteration
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
-import os, json, subprocess, hashlib
+import os, json, subprocess, hashlib, shutil, time, mmap, re, threading, socket
+import urllib.error, urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 
+# Let the Rust tokenizer split batches across threads; must be set before it is imported.
+# Nothing forks after embedding starts (llama calls all happen before), so this is safe.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
 # Project root
 BASE = Path(__file__).resolve().parents[1]
 
@@ -29,10 +35,32 @@ NOTES_DIR = BASE / "notes"
 SUMMARIES_PATH = BASE / cfg.get("summaries_path", "memory/summaries.json")
 EMBEDDINGS_NPY = BASE / cfg.get("embeddings_npy", "memory/embeddings.npy")
 FAISS_INDEX = BASE / cfg.get("faiss_index", "memory/faiss.index")
+# Which summary each embeddings.npy row holds, so re-runs only encode and write changed rows
+EMBED_MANIFEST = EMBEDDINGS_NPY.with_name(EMBEDDINGS_NPY.stem + "_manifest.json")
 CHUNK_SIZE = int(cfg.get("chunk_size_chars", 3000))
 CHUNK_OVERLAP = int(cfg.get("chunk_overlap_chars", 300))
+# Notes at least this big are chunked straight from an mmap instead of a decoded str
+MMAP_MIN_BYTES = 4 * 1024 * 1024
+# Summaries are embedded this many at a time, straight into the preallocated matrix
+EMBED_SLICE = 4096
+# Above this many summaries, encoding is sharded over worker processes (CPU cores or GPUs)
+EMBED_POOL_MIN = int(cfg.get("embed_pool_min", 500))
+# Past this many docs the index is IVF (approximate) instead of an exact flat scan
+IVF_MIN_DOCS = int(cfg.get("faiss_ivf_min_docs", 100_000))
+IVF_NPROBE = int(cfg.get("faiss_ivf_nprobe", 16))
 LLAMA_CMD = cfg.get("llama_cli", "llama")
 MODEL_PATH = BASE / cfg.get("model_path", "model/Mistral-Nemo-Base-12B.Q4_K_M.gguf")
+# sha256(chunk) -> accepted summary, so re-runs only summarize new or changed chunks
+CHUNK_CACHE = BASE / "memory" / "chunk_cache.json"
+# Summaries go through a llama-server kept up for the whole run, on a free port picked at
+# start (a fixed one could be answered by a leftover server holding another model);
+# None means fall back to one CLI call per chunk
+_server_url = None
+_server_proc = None
+_server_slots = 1
+# A server that dies mid-run is brought back this many times before chunks go to the CLI
+_server_restarts = int(cfg.get("summarize_server_restarts", 1))
+_server_lock = threading.Lock()
 
 # ----------------------------
 # Helpers
@@ -44,20 +72,214 @@ def list_note_files():
 def read_text(p): 
     return p.read_text(encoding="utf-8", errors="ignore")
 
+def chunk_offsets(L, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Start offsets of `size`-long windows over L chars, each sharing `overlap` with the previous one."""
+    assert 0 <= overlap < size, "chunk_overlap_chars must be smaller than chunk_size_chars"
+    if not L:
+        return range(0)
+    stride = size - overlap
+    # last window is the first one that reaches the end; no trailing overlap-only window
+    n_chunks = max(1, (L - overlap + stride - 1) // stride)
+    return range(0, n_chunks * stride, stride)
+
 def chunk_text(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
-    chunks, i, L = [], 0, len(text)
-    while i < L:
-        end = i + size
-        chunks.append(text[i:end].strip())
-        i = end - overlap
-    return chunks
+    """Sliding windows of `size` chars, each sharing `overlap` chars with the previous one."""
+    text = text.strip()  # once for the document; esophagus_transport trims each chunk
+    return [text[s:s + size] for s in chunk_offsets(len(text), size, overlap)]
+
+def _server_bin():
+    """llama-server next to the configured llama CLI, else from PATH."""
+    cli = shutil.which(LLAMA_CMD) or LLAMA_CMD
+    sibling = Path(cli).with_name("llama-server")
+    if sibling.exists():
+        return str(sibling)
+    return shutil.which("llama-server")
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _server_healthy(proc, url):
+    """Only our own, still-running server counts, whatever else answers on the port."""
+    if proc.poll() is not None:
+        return False
+    try:
+        with urllib.request.urlopen(url + "/health", timeout=1) as resp:
+            return resp.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+def start_llama_server(n_parallel=1, timeout=180):
+    """Load the model once for the whole run. Returns the server process, or None to use the CLI."""
+    global _server_url, _server_proc, _server_slots
+    server_bin = _server_bin()
+    if not server_bin:
+        print("  [LLAMA] llama-server not found; summarizing with one CLI call per chunk")
+        return None
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    cmd = [
+        server_bin, "-m", str(MODEL_PATH),
+        "--host", "127.0.0.1", "--port", str(port),
+        "-c", str(8192 * n_parallel), "-np", str(n_parallel), "-ngl", "999",
+    ]
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        print(f"  [LLAMA] Could not start llama-server: {e}")
+        return None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            print(f"  [LLAMA] llama-server exited with code {proc.returncode}; using CLI")
+            return None
+        if _server_healthy(proc, url):
+            _server_url, _server_proc, _server_slots = url, proc, n_parallel
+            print(f"  [LLAMA] llama-server ready at {url} ({n_parallel} slots)")
+            return proc
+        time.sleep(0.25)
+    print("  [LLAMA] llama-server not healthy in time; using CLI")
+    stop_llama_server(proc)
+    return None
+
+def stop_llama_server(proc):
+    global _server_url, _server_proc
+    _server_url = None
+    if proc is _server_proc:
+        _server_proc = None
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def _current_server():
+    """(url, proc) of the summarize server; blocks while another worker is restarting it."""
+    with _server_lock:
+        return _server_url, _server_proc
+
+def _server_alive(proc):
+    return proc is not None and proc.poll() is None
+
+def _revive_server(failed_proc):
+    """After a failed request: True if a live server is (again) up to retry on.
+    
+    Holds _server_lock for the whole restart, so other workers wait in _current_server()
+    instead of seeing no server and loading the model a second time through the CLI.
+    """
+    global _server_restarts
+    with _server_lock:
+        if _server_proc is not failed_proc:
+            return _server_url is not None  # another worker already restarted it
+        if failed_proc is None or _server_restarts <= 0:
+            return False
+        try:
+            failed_proc.wait(timeout=1)  # a dropped connection can beat the exit status
+        except subprocess.TimeoutExpired:
+            return False  # server still running: slow or bad request, not a crash
+        _server_restarts -= 1
+        print(f"  [LLAMA] llama-server died (code {failed_proc.returncode}); restarting")
+        stop_llama_server(failed_proc)
+        return start_llama_server(n_parallel=_server_slots) is not None
+
+def _first_lines(output):
+    lines = [l.strip() for l in output.splitlines() if l.strip()]
+    return " ".join(lines[:2])
+
+# Sampling for every summary, on the server and the CLI alike
+SUMMARIZE_N_PREDICT = 256
+SUMMARIZE_TEMP = 0.2
+SUMMARIZE_PROMPT = "Summarize the following text into 1-2 short bullet sentences (keep it factual):\n\n{text}\n\nSummary:"
+
+def _server_summarize(url, prompt):
+    payload = {"prompt": prompt, "n_predict": SUMMARIZE_N_PREDICT, "temperature": SUMMARIZE_TEMP,
+               "cache_prompt": True}
+    req = urllib.request.Request(
+        url + "/completion",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=120) as resp:
+        return _first_lines(json.loads(resp.read()).get("content", ""))
+
+_NON_WS = re.compile(rb"\S")
+
+def iter_chunks(path, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """chunk_text() over the file's bytes via mmap, decoding one window at a time.
+    
+    Yields ((path, lo, hi), text): the byte span is what gets kept, and chunk_str()
+    re-decodes it when the text is needed. Windows are measured in UTF-8 bytes, and a
+    character split at a window edge is dropped.
+    """
+    mm = _note_map(path)
+    if mm is None:
+        return
+    m = _NON_WS.search(mm)
+    if not m:
+        return
+    start, end = m.start(), len(mm)
+    while mm[end - 1] in b" \t\r\n\x0b\x0c":
+        end -= 1
+    for s in chunk_offsets(end - start, size, overlap):
+        lo, hi = start + s, min(start + s + size, end)
+        yield (path, lo, hi), mm[lo:hi].decode("utf-8", "ignore")
+
+# path -> read-only mmap of a huge note, mapped once and shared by every span of it
+_note_maps = {}
+_note_maps_lock = threading.Lock()
+
+def _note_map(path):
+    """The note's mmap (None for an empty file); summarize workers call this concurrently."""
+    with _note_maps_lock:
+        if path not in _note_maps:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                _note_maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        return _note_maps[path]
+
+def close_note_maps():
+    with _note_maps_lock:
+        for mm in _note_maps.values():
+            if mm is not None:
+                mm.close()
+        _note_maps.clear()
+
+def chunk_str(chunk):
+    """Chunk text; chunks of huge notes are kept as (path, lo, hi) byte spans until needed."""
+    if isinstance(chunk, str):
+        return chunk
+    path, lo, hi = chunk
+    return _note_map(path)[lo:hi].decode("utf-8", "ignore").strip()
 
 def llama_summarize(text_chunk):
-    prompt = f"Summarize the following text into 1-2 short bullet sentences (keep it factual):\n\n{text_chunk}\n\nSummary:"
+    prompt = SUMMARIZE_PROMPT.format(text=text_chunk)
+    url, proc = _current_server()
+    if url:
+        try:
+            return _server_summarize(url, prompt)
+        except Exception as e:
+            err = e
+        # keep the model loaded rather than paying a CLI model load for every remaining chunk
+        if _revive_server(proc):
+            url, proc = _current_server()
+            try:
+                return _server_summarize(url, prompt)
+            except Exception as e:
+                err = e
+        if _server_alive(_current_server()[1]):
+            # the server still holds the model; the CLI would load a second copy
+            print(f"  [LLAMA] Server request failed ({err}); skipping chunk")
+            return ""
+        print(f"  [LLAMA] Server request failed ({err}); retrying with CLI")
     try:
-        # Use proper encoding with errors='ignore' to handle binary output
-        cmd = f'printf "%s" {json.dumps(prompt)} | {LLAMA_CMD} -m {str(MODEL_PATH)} --n_predict 256 --temp 0.2'
-        p = subprocess.run(["bash","-lc", cmd], capture_output=True, timeout=120, text=False)
+        # argv + stdin, no shell: nothing in the prompt is ever parsed as shell syntax.
+        # Output stays bytes and is decoded with errors='ignore' to handle binary output.
+        cmd = [LLAMA_CMD, "-m", str(MODEL_PATH), "--n_predict", str(SUMMARIZE_N_PREDICT),
+               "--temp", str(SUMMARIZE_TEMP), "-f", "/dev/stdin"]
+        p = subprocess.run(cmd, input=prompt.encode("utf-8"), capture_output=True, timeout=120)
         
         # Decode with error handling
         try:
@@ -66,8 +288,7 @@ def llama_summarize(text_chunk):
             output = ""
         
         if p.returncode == 0 and output:
-            lines = [l.strip() for l in output.splitlines() if l.strip()]
-            return " ".join(lines[:2])
+            return _first_lines(output)
         else:
             if p.stderr:
                 try:
@@ -83,6 +304,32 @@ def llama_summarize(text_chunk):
         print(f"  [LLAMA] Error: {e}")
         return ""
 
+def _summary_settings():
+    """Hash of everything besides the chunk that shapes its summary: prompts and sampling."""
+    settings = [SUMMARIZE_PROMPT, DIGEST_PROMPT, SUMMARIZE_N_PREDICT, SUMMARIZE_TEMP]
+    return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()
+
+def load_chunk_cache():
+    """Summaries from earlier runs, keyed by chunk sha256; empty if the model or prompts changed."""
+    try:
+        with open(CHUNK_CACHE, "r") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if data.get("model") != MODEL_PATH.name or data.get("settings") != _summary_settings():
+        return {}
+    return data.get("summaries", {})
+
+def save_chunk_cache(summaries):
+    try:
+        CHUNK_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = CHUNK_CACHE.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"model": MODEL_PATH.name, "settings": _summary_settings(), "summaries": summaries}, f)
+        os.replace(tmp, CHUNK_CACHE)
+    except OSError as e:
+        print(f"  [STOMACH] Warning: could not save chunk cache: {e}")
+
 def try_imports():
     try:
         import numpy as np
@@ -92,6 +339,99 @@ def try_imports():
         print("Missing python packages: sentence-transformers, faiss-cpu, numpy")
         raise
 
+def load_embedder(SentenceTransformer):
+    """SentenceTransformer on CUDA (fp16) or MPS when available, else CPU.
+    
+    Always asks for the fast (Rust) tokenizer. On CPU, torch uses all cores (up to 8);
+    setting embedding_backend to "onnx" in config.json loads the int8-quantized ONNX
+    export instead (needs `optimum[onnxruntime]`).
+    """
+    name = cfg.get("embedding_model", "sentence-transformers/all-MiniLM-L6-v2")
+    device = "cpu"
+    try:
+        import torch
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+            device = "mps"
+        else:
+            torch.set_num_threads(min(8, os.cpu_count() or 4))
+            try:
+                torch.set_num_interop_threads(2)
+            except RuntimeError:
+                pass  # only settable before torch starts its interop pool
+    except Exception:
+        pass
+    if device == "cpu" and cfg.get("embedding_backend") == "onnx":
+        onnx_file = cfg.get("embedding_onnx_file", "onnx/model_qint8_avx512_vnni.onnx")
+        try:
+            embedder = SentenceTransformer(name, device=device, backend="onnx",
+                                           model_kwargs={"file_name": onnx_file},
+                                           tokenizer_kwargs={"use_fast": True})
+            print(f"[EMBED] {name} on cpu (onnx: {onnx_file})")
+            return embedder
+        except Exception as e:
+            print(f"  [EMBED] ONNX backend unavailable ({e}); using torch")
+    try:
+        embedder = SentenceTransformer(name, device=device, tokenizer_kwargs={"use_fast": True})
+        if device == "cuda":
+            embedder = embedder.half()
+    except Exception as e:
+        if device == "cpu":
+            raise
+        print(f"  [EMBED] Could not use {device} ({e}); falling back to CPU")
+        device = "cpu"
+        embedder = SentenceTransformer(name, device=device, tokenizer_kwargs={"use_fast": True})
+    if not getattr(getattr(embedder, "tokenizer", None), "is_fast", True):
+        print("  [EMBED] Using the slow Python tokenizer; `pip install tokenizers` for the fast one")
+    print(f"[EMBED] {name} on {device}")
+    return embedder
+
+def start_embed_pool(embedder, n_texts):
+    """encode_multi_process worker pool for large batches, or None to encode in this process.
+    
+    On CPU the cores are split between embed_processes workers (default up to 4);
+    on CUDA one worker per GPU, only when there is more than one.
+    """
+    if n_texts <= EMBED_POOL_MIN or cfg.get("embedding_backend") == "onnx":
+        return None
+    device = str(getattr(embedder, "device", "cpu"))
+    cpus = os.cpu_count() or 1
+    if device == "cpu":
+        n = int(cfg.get("embed_processes", min(4, cpus)))
+        targets = ["cpu"] * n
+    elif device.startswith("cuda"):
+        import torch
+        targets = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    else:
+        return None
+    if len(targets) < 2:
+        return None
+    # Workers are spawned fresh and size torch's pool from this; without it each takes every core
+    saved = os.environ.get("OMP_NUM_THREADS")
+    if device == "cpu":
+        os.environ["OMP_NUM_THREADS"] = str(max(1, cpus // len(targets)))
+    try:
+        pool = embedder.start_multi_process_pool(target_devices=targets)
+    except Exception as e:
+        print(f"  [EMBED] Could not start worker processes ({e}); encoding in-process")
+        return None
+    finally:
+        if saved is None:
+            os.environ.pop("OMP_NUM_THREADS", None)
+        else:
+            os.environ["OMP_NUM_THREADS"] = saved
+    print(f"[EMBED] Encoding {n_texts} summaries on {len(targets)} worker processes ({device})")
+    return pool
+
+def token_lengths(embedder, texts):
+    """Token count per text (what padding is measured in), or char count if the tokenizer can't say."""
+    try:
+        ids = embedder.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(x) for x in ids]
+    except Exception:
+        return [len(t) for t in texts]
+
 # ----------------------------
 # Build memory
 # ----------------------------
@@ -186,10 +526,14 @@ def mouth_taste_and_saliva(text):
     return text
 
 def esophagus_transport(chunks):
-    """ESOPHAGUS: Normalize, trim, deduplicate consecutive chunks."""
+    """ESOPHAGUS: Normalize, trim, deduplicate consecutive chunks.
+    
+    Chunks given as (span, text) pairs (see iter_chunks) come back as their span.
+    """
     normalized, prev_hash = [], None
     
     for chunk in chunks:
+        span, chunk = chunk if isinstance(chunk, tuple) else (None, chunk)
         c = chunk.strip()
         if len(c) < 50:
             continue  # Skip tiny fragments
@@ -201,14 +545,12 @@ def esophagus_transport(chunks):
             continue
         
         prev_hash = c_hash
-        normalized.append(c)
+        normalized.append(c if span is None else span)
     
     print(f"  [ESOPHAGUS] Passed {len(normalized)} deduplicated chunks")
     return normalized
 
-def stomach_digest(chunk):
-    """STOMACH: Extract ONLY concrete facts about Kara, Drax, their bond. No fantasy drift."""
-    prompt = f"""You are a ruthless fact-extractor. Extract ONLY verified facts about the characters.
+DIGEST_PROMPT = """You are a ruthless fact-extractor. Extract ONLY verified facts about the characters.
 Your output MUST be 3-5 bullet points. Each must be a concrete, factual claim (not opinion, not roleplay).
 
 RULES:
@@ -221,6 +563,10 @@ Text to extract from:
 {chunk}
 
 Facts:"""
+
+def stomach_digest(chunk):
+    """STOMACH: Extract ONLY concrete facts about Kara, Drax, their bond. No fantasy drift."""
+    prompt = DIGEST_PROMPT.format(chunk=chunk)
     
     summary = llama_summarize(prompt) if prompt else ""
     
@@ -264,9 +610,41 @@ def large_intestine_recycle(summaries_list):
     print(f"  [LARGE_INT] Deduped {len(summaries_list)} → {len(deduped)} summaries")
     return deduped
 
-def small_intestine_absorb(summaries_list, vectors_list):
-    """SMALL_INTESTINE: Build embeddings + FAISS index + clean memory.json + brain.json"""
-    if not summaries_list or not vectors_list:
+def summary_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_embedding_rows(dim):
+    """Previous run's manifest keys and a read-only memmap of embeddings.npy, if still usable."""
+    import numpy as np
+    try:
+        with open(EMBED_MANIFEST, "r") as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return [], None
+    if manifest.get("model") != cfg.get("embedding_model", "sentence-transformers/all-MiniLM-L6-v2"):
+        return [], None
+    keys = manifest.get("keys", [])
+    try:
+        old = np.lib.format.open_memmap(str(EMBEDDINGS_NPY), mode="r")
+    except (OSError, ValueError):
+        return [], None
+    if old.shape != (len(keys), dim) or old.dtype != np.float32:
+        return [], None
+    return keys, old
+
+def save_embedding_manifest(keys):
+    tmp = EMBED_MANIFEST.with_suffix(".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"model": cfg.get("embedding_model", "sentence-transformers/all-MiniLM-L6-v2"),
+                   "keys": keys}, f)
+    os.replace(tmp, EMBED_MANIFEST)
+
+def small_intestine_absorb(summaries_list, vectors_list, changed_rows=None):
+    """SMALL_INTESTINE: Build embeddings + FAISS index + clean memory.json + brain.json
+    
+    With changed_rows, embeddings.npy already holds every other row and only those are written.
+    """
+    if not summaries_list or len(vectors_list) == 0:
         print("[SMALL_INT] No summaries to absorb!")
         return False
     
@@ -274,30 +652,46 @@ def small_intestine_absorb(summaries_list, vectors_list):
         import numpy as np
         import faiss
         
-        vectors_array = np.array(vectors_list, dtype=np.float32)
+        vectors_array = np.ascontiguousarray(vectors_list, dtype=np.float32)
         
-        # Normalize for cosine similarity
-        np.linalg.norm(vectors_array, axis=1, keepdims=True)
-        for i in range(len(vectors_array)):
-            norm = np.linalg.norm(vectors_array[i])
-            if norm > 0:
-                vectors_array[i] = vectors_array[i] / norm
+        # Normalize for cosine similarity (whole matrix, in place)
+        faiss.normalize_L2(vectors_array)
         
-        # Save embeddings
-        np.save(str(EMBEDDINGS_NPY), vectors_array)
-        print(f"  [SMALL_INT] Saved embeddings: {EMBEDDINGS_NPY}")
+        # Save embeddings: rewrite only the changed rows in place when the shape is unchanged
+        on_disk = None
+        if changed_rows is not None:
+            try:
+                on_disk = np.lib.format.open_memmap(str(EMBEDDINGS_NPY), mode="r+")
+            except (OSError, ValueError):
+                pass
+        if on_disk is not None and on_disk.shape == vectors_array.shape and on_disk.dtype == vectors_array.dtype:
+            on_disk[changed_rows] = vectors_array[changed_rows]
+            on_disk.flush()
+            print(f"  [SMALL_INT] Updated {len(changed_rows)} of {len(vectors_array)} rows: {EMBEDDINGS_NPY}")
+        else:
+            np.save(str(EMBEDDINGS_NPY), vectors_array)
+            print(f"  [SMALL_INT] Saved embeddings: {EMBEDDINGS_NPY}")
+        del on_disk
         
         # Save summaries
         with open(SUMMARIES_PATH, "w") as f:
             json.dump(summaries_list, f, indent=2)
         print(f"  [SMALL_INT] Saved summaries: {SUMMARIES_PATH}")
         
-        # Build FAISS index
-        dimension = vectors_array.shape[1]
-        index = faiss.IndexFlatIP(dimension)  # Inner product = cosine if normalized
+        # Build FAISS index: one batched add of the whole matrix
+        n_docs, dimension = vectors_array.shape
+        if n_docs > IVF_MIN_DOCS:
+            # Large corpora: inverted lists so a query scans ~nprobe/nlist of the docs
+            nlist = int(4 * np.sqrt(n_docs))
+            quantizer = faiss.IndexFlatIP(dimension)
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors_array)
+            index.nprobe = IVF_NPROBE  # saved with the index, so run_llm needs no change
+        else:
+            index = faiss.IndexFlatIP(dimension)  # Inner product = cosine if normalized
         index.add(vectors_array)
         faiss.write_index(index, str(FAISS_INDEX))
-        print(f"  [SMALL_INT] Built FAISS index: {FAISS_INDEX} (docs={len(vectors_array)})")
+        print(f"  [SMALL_INT] Built FAISS index: {FAISS_INDEX} ({type(index).__name__}, docs={n_docs})")
         
         # Extract verified facts for memory.json
         verified_facts = []
@@ -446,7 +840,7 @@ def build_memory():
         return
 
     np, SentenceTransformer = try_imports()
-    embedder = SentenceTransformer(cfg.get("embedding_model", "sentence-transformers/all-MiniLM-L6-v2"))
+    embedder = load_embedder(SentenceTransformer)
 
     # Stage 1: MOUTH - initial filter
     rejected = []
@@ -454,7 +848,8 @@ def build_memory():
     for p in files:
         text = read_text(p)
         if mouth_taste_and_saliva(text):
-            files_after_mouth.append((p, text))
+            # keep small notes decoded; large ones are re-read lazily from an mmap in stage 2
+            files_after_mouth.append((p, text if p.stat().st_size < MMAP_MIN_BYTES else None))
         else:
             rejected.append(text[:100])
     
@@ -464,29 +859,68 @@ def build_memory():
     # Stage 2: ESOPHAGUS - chunk & deduplicate
     all_chunks = []
     for p, text in files_after_mouth:
-        chunks = chunk_text(text)
+        chunks = chunk_text(text) if text is not None else iter_chunks(p)
         chunks = esophagus_transport(chunks)
         all_chunks.extend([(p.name, c) for c in chunks])
     
     print(f"[ESOPHAGUS] Total chunks ready: {len(all_chunks)}")
     
     # Stage 3: STOMACH - digest into summaries
-    summaries, vectors, rejected_chunks = [], [], []
-    for source_file, chunk in all_chunks:
-        chunk_id = hashlib.sha256((source_file + chunk[:50]).encode()).hexdigest()[:12]
-        print(f"\n[STOMACH] Processing {source_file}#{chunk_id} ({len(chunk)} chars)...")
-        summary = stomach_digest(chunk)
-        
+    # Chunks are independent, so run several llama calls at once; results are
+    # collected by position so the output order doesn't depend on completion order.
+    workers = max(1, int(cfg.get("summarize_workers", 2)))
+    # Content hashes key the cache and the chunk ids, so renaming a note changes neither
+    hashes, lengths = [], []
+    for _, chunk in all_chunks:
+        text = chunk_str(chunk)
+        hashes.append(hashlib.sha256(text.encode("utf-8")).hexdigest())
+        lengths.append(len(text))
+    chunk_ids = [h[:12] for h in hashes]
+    cache = load_chunk_cache()
+    digested = [cache.get(h) for h in hashes]
+    pending = {}  # hash -> chunk indices with that content; identical chunks are summarized once
+    for idx, h in enumerate(hashes):
+        if digested[idx] is None:
+            pending.setdefault(h, []).append(idx)
+    n_cached = len(all_chunks) - sum(len(v) for v in pending.values())
+    print(f"[STOMACH] {n_cached} chunks cached, {len(pending)} to summarize")
+    if pending:
+        start_llama_server(n_parallel=workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futs = {}
+            for h, positions in pending.items():
+                source_file, chunk = all_chunks[positions[0]]
+                print(f"[STOMACH] Queued {source_file}#{h[:12]} ({lengths[positions[0]]} chars)")
+                # spans are decoded in the worker, so queued chunks don't hold their text
+                futs[ex.submit(lambda c: stomach_digest(chunk_str(c)), chunk)] = h
+            for done, fut in enumerate(as_completed(futs), 1):
+                h = futs[fut]
+                summary = fut.result()
+                if summary:
+                    cache[h] = summary
+                for idx in pending[h]:
+                    digested[idx] = summary
+                source_file, _ = all_chunks[pending[h][0]]
+                print(f"\n[STOMACH] Processed {source_file}#{h[:12]} ({done}/{len(futs)})")
+    finally:
+        stop_llama_server(_server_proc)
+    if pending:
+        save_chunk_cache(cache)
+    
+    summaries, rejected_chunks = [], []
+    for (source_file, chunk), chunk_id, length, summary in zip(all_chunks, chunk_ids, lengths, digested):
         if summary:
             summaries.append({
                 "id": chunk_id,
                 "source": source_file,
                 "summary": summary,
-                "length": len(chunk)
+                "length": length
             })
-            vectors.append(embedder.encode(summary))
         else:
-            rejected_chunks.append(chunk[:100])
+            rejected_chunks.append(chunk_str(chunk)[:100])
+    # every span has been decoded for the last time
+    close_note_maps()
     
     print(f"\n[STOMACH] Digested {len(summaries)} summaries, rejected {len(rejected_chunks)}")
     anus_discard(rejected_chunks, "stomach_filter")
@@ -494,9 +928,58 @@ def build_memory():
     # Stage 4: LARGE_INTESTINE - recycle & dedupe
     summaries = large_intestine_recycle(summaries)
     
+    # Embed the surviving summaries into one preallocated float32 matrix, so vectors
+    # line up with the deduped list. Summaries embedded by an earlier run (same model)
+    # are copied from the old embeddings.npy; only new ones are encoded. Length-sorted
+    # input keeps padding within each mini-batch small; slices are written in place.
+    summary_texts = [s["summary"] for s in summaries]
+    keys = [summary_key(t) for t in summary_texts]
+    dim = embedder.get_sentence_embedding_dimension()
+    vectors = np.empty((len(summary_texts), dim), dtype=np.float32)
+    old_keys, old = load_embedding_rows(dim)
+    old_rows = {k: j for j, k in enumerate(old_keys)}
+    todo = [i for i, k in enumerate(keys) if k not in old_rows]
+    reused = [i for i, k in enumerate(keys) if k in old_rows]
+    if reused:
+        vectors[reused] = old[[old_rows[keys[i]] for i in reused]]
+    # Same row count: rows that kept their summary are already on disk
+    changed_rows = None
+    if old is not None and len(old_keys) == len(keys):
+        changed_rows = [i for i, (k, ok) in enumerate(zip(keys, old_keys)) if k != ok]
+    del old  # unmap before embeddings.npy is rewritten
+    print(f"[EMBED] {len(reused)} embeddings reused, {len(todo)} to encode")
+    if todo:
+        todo_texts = [summary_texts[i] for i in todo]
+        order = np.asarray(todo)[np.argsort(token_lengths(embedder, todo_texts), kind="stable")]
+        pool = start_embed_pool(embedder, len(todo))
+        try:
+            for start in range(0, len(order), EMBED_SLICE):
+                rows = order[start:start + EMBED_SLICE]
+                batch = [summary_texts[i] for i in rows]
+                # fp16 on GPU; FAISS and embeddings.npy stay float32
+                if pool is not None:
+                    vectors[rows] = embedder.encode_multi_process(
+                        batch, pool, batch_size=32, chunk_size=64, normalize_embeddings=True,
+                    )
+                else:
+                    vectors[rows] = embedder.encode(
+                        batch, batch_size=64, convert_to_numpy=True, normalize_embeddings=True,
+                        show_progress_bar=True,
+                    )
+        finally:
+            if pool is not None:
+                embedder.stop_multi_process_pool(pool)
+    
     # Stage 5: SMALL_INTESTINE - absorb (save to disk + build FAISS)
     print(f"\n[SMALL_INT] Absorbing nutrients...")
-    success = small_intestine_absorb(summaries, vectors)
+    # drop the manifest first, so an interrupted write can't leave it describing other rows
+    try:
+        EMBED_MANIFEST.unlink()
+    except FileNotFoundError:
+        pass
+    success = small_intestine_absorb(summaries, vectors, changed_rows)
+    if success:
+        save_embedding_manifest(keys)
     
     if success:
         print(f"\n✓ Memory digestion complete! {len(summaries)} chunks in stomach.")
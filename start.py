@@ -32,10 +32,10 @@ def load_characters():
         return json.load(f)
 
 
-def update_config(config_path, character_id, llm_id):
-    """Update the character and model selection in config.json."""
-    with open(config_path) as f:
-        config = json.load(f)
+def update_config(config_path, config, character_id, llm_id):
+    """Update the character and model selection in config and write it to config.json."""
+    if (config.get("current_character"), config.get("current_llm")) == (character_id, llm_id):
+        return  # nothing changed; skip rewriting the file
     
     config["current_character"] = character_id
     config["current_llm"] = llm_id
@@ -166,7 +166,7 @@ def main():
     selected_llm = select_llm(characters_data, current_llm)
     
     # Update config with selections
-    update_config("config.json", selected_character, selected_llm)
+    update_config("config.json", config, selected_character, selected_llm)
     
     # Get character and LLM details
     char_info = next((c for c in characters_data["characters"] 
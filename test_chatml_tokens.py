@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Test that the split ChatML tokenization in diagnostics matches tokenizing the whole prompt."""
+import json
+import os
+import re
+import sys
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, project_root)
+
+from diagnostics import diagnostics as diag
+
+SPECIAL = {"<|im_start|>": 32001, "<|im_end|>": 32000}
+_SPECIAL_RE = re.compile("(" + "|".join(re.escape(t) for t in SPECIAL) + ")")
+
+
+class FakeLlama:
+    """Mimics llama.cpp: split on special tokens, SentencePiece space prefix after each one."""
+
+    def __init__(self, lstrip_im_end=False):
+        self.lstrip_im_end = lstrip_im_end  # like vocabularies whose <|im_end|> eats leading whitespace
+
+    def tokenize(self, text, add_bos=True, special=False):
+        parts = _SPECIAL_RE.split(text.decode("utf-8")) if special else [text.decode("utf-8")]
+        toks = [1] if add_bos else []
+        prev_special = True
+        for i, part in enumerate(parts):
+            if part in SPECIAL and special:
+                toks.append(SPECIAL[part])
+                prev_special = True
+                continue
+            if self.lstrip_im_end and i + 1 < len(parts) and parts[i + 1] == "<|im_end|>":
+                part = part.rstrip()
+            if not part:
+                continue
+            toks += [ord(c) for c in ((" " if prev_special else "") + part).replace(" ", "▁")]
+            prev_special = False
+        return toks
+
+
+test_prompts = [
+    "hello",
+    " leading space",
+    "two\nlines\n",
+    "trailing space ",
+    "unicode: café ☕",
+    "",
+]
+
+passed = 0
+total = 0
+
+print("Testing _chatml_prompt_tokens() with a llama.cpp-like tokenizer:\n")
+for name, llm, expect_split in (("plain vocab", FakeLlama(), True),
+                                ("lstrip <|im_end|>", FakeLlama(lstrip_im_end=True), False)):
+    model_path = f"/fake/{name}.gguf"
+    diag._get_llm = lambda path, llm=llm: llm
+    diag._chatml_wrapper_tokens.cache_clear()
+    diag._chatml_split_ok.pop(model_path, None)
+    for prompt in test_prompts:
+        total += 1
+        got = diag._chatml_prompt_tokens(llm, model_path, prompt)
+        want = llm.tokenize(diag._build_chatml_prompt(prompt).encode("utf-8"), add_bos=True, special=True)
+        status = "✓" if got == want else "✗"
+        passed += got == want
+        print(f"{status} {name:18} | {prompt!r}")
+    total += 1
+    split_ok = diag._chatml_split_ok.get(model_path)
+    status = "✓" if split_ok is expect_split else "✗"
+    passed += split_ok is expect_split
+    print(f"{status} {name:18} | split tokenization {'kept' if split_ok else 'disabled'}\n")
+
+# Same check against the configured model when llama-cpp-python is installed
+config_path = os.path.join(project_root, "config.json")
+if diag.Llama is not None and os.path.exists(config_path):
+    with open(config_path, "r") as f:
+        model_path = json.load(f).get("model_path", "")
+    if os.path.exists(model_path):
+        llm = diag.Llama(model_path=model_path, vocab_only=True, verbose=False)
+        diag._get_llm = lambda path: llm
+        diag._chatml_wrapper_tokens.cache_clear()
+        for prompt in test_prompts:
+            # forget the first-use check each time so every prompt is compared to the full prompt
+            total += 1
+            diag._chatml_split_ok.pop(model_path, None)
+            diag._chatml_prompt_tokens(llm, model_path, prompt)
+            split_ok = diag._chatml_split_ok[model_path]
+            status = "✓" if split_ok else "✗"
+            passed += split_ok
+            print(f"{status} {os.path.basename(model_path):18} | {prompt!r}")
+else:
+    print("(llama_cpp not installed; skipping the real-model check)")
+
+print(f"\nPassed: {passed}/{total}")
+sys.exit(0 if passed == total else 1)
@@ -5,9 +5,16 @@ Saves debug output to tests/ directory and shows full llama.cpp logs.
 """
 
 import os
+import re
+import socket
 import sys
 import subprocess
 import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Get project root and config
@@ -21,6 +28,111 @@ with open(config_path, "r") as f:
 llama_cli = config["llama_cpp_path"]
 model_path = config["model_path"]
 
+# The response starts after llama.cpp's "generate: n_ctx ..." line; perf/memory/metal
+# log lines printed around it are not part of the response.
+_GEN = re.compile(r"\s*generate: n_ctx")
+_SKIP = re.compile(r"\s*(?:llama_perf|llama_memory|ggml_metal)")
+
+# The test prompts share one llama-server (model loaded once, prompts decoded concurrently).
+# It gets a free port at start, so no other (or leftover) server can answer for it.
+SERVER_URL = None
+# Same sampling as the llama-cli command in run_debug_test
+SERVER_PARAMS = {
+    "n_predict": 100, "temperature": 0.7, "top_k": 40, "top_p": 0.95,
+    "repeat_penalty": 1.1, "cache_prompt": True,
+}
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _server_healthy(proc):
+    """Only counts while our own server process is still running."""
+    if proc.poll() is not None:
+        return False
+    try:
+        with urllib.request.urlopen(SERVER_URL + "/health", timeout=1) as resp:
+            return resp.status == 200
+    except (urllib.error.URLError, OSError):
+        return False
+
+def start_debug_server(log_file: str, n_parallel: int, timeout: float = 120.0):
+    """Launch llama-server next to llama-cli, logging to log_file. Returns the process or None."""
+    global SERVER_URL
+    server_bin = os.path.join(os.path.dirname(llama_cli), "llama-server")
+    if not os.path.exists(server_bin):
+        print(f"[debug-server] {server_bin} not found; running prompts through llama-cli")
+        return None
+    port = _free_port()
+    SERVER_URL = f"http://127.0.0.1:{port}"
+    cmd = [
+        server_bin,
+        "--model", model_path,
+        "--host", "127.0.0.1",
+        "--port", str(port),
+        "--ctx-size", str(4096 * n_parallel),  # 4096 per slot, as for llama-cli
+        "--parallel", str(n_parallel),
+        "--n-gpu-layers", "999",
+    ]
+    print(f"[debug-server] {' '.join(cmd[:3])} ... (log: {log_file})")
+    try:
+        with open(log_file, "w", encoding="utf-8") as log:
+            log.write(f"=== Debug Server: {datetime.now().isoformat()} ===\n")
+            log.write(f"Command: {' '.join(cmd)}\n")
+            log.flush()
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    except OSError as e:
+        print(f"[debug-server] Failed to launch: {e}")
+        return None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            print(f"[debug-server] Exited with code {proc.returncode}; running prompts through llama-cli")
+            return None
+        if _server_healthy(proc):
+            return proc
+        time.sleep(0.25)
+    print("[debug-server] Not healthy in time; running prompts through llama-cli")
+    stop_debug_server(proc)
+    return None
+
+def stop_debug_server(proc):
+    if proc is None or proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+def run_server_test(prompt: str, output_file: str = None):
+    """Run a single prompt against the debug server; saves the raw JSON reply"""
+    payload = dict(SERVER_PARAMS, prompt=prompt)
+    req = urllib.request.Request(
+        SERVER_URL + "/completion",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=60) as resp:
+            status, body = resp.status, resp.read().decode("utf-8", errors="replace")
+        reply = json.loads(body)
+    except Exception as e:
+        print(f"[debug-error] {prompt[:30]!r}: {e}")
+        return False, ""
+    
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(f"=== Debug Test: {datetime.now().isoformat()} ===\n")
+            f.write(f"Request: POST {SERVER_URL}/completion {json.dumps(payload)}\n")
+            f.write(f"HTTP status: {status}\n")
+            f.write("=== Full Output ===\n")
+            f.write(json.dumps(reply, indent=2))
+        print(f"[debug-save] Output saved to {output_file}")
+    
+    return status == 200, reply.get("content", "").strip()
+
 def run_debug_test(prompt: str, output_file: str = None):
     """Run a single prompt with full debug output"""
     
@@ -42,56 +154,67 @@ def run_debug_test(prompt: str, output_file: str = None):
     
     print(f"[debug-run] {' '.join(cmd[:6])} ... -p \"{prompt[:30]}...\"")
     
+    # Stream llama.cpp's output: each line goes to the log file and through the response
+    # extraction as it arrives, so the full log is never held in memory
+    out = open(output_file, "w", encoding="utf-8") if output_file else None
+    timed_out = threading.Event()
     try:
-        result = subprocess.run(
+        if out:
+            out.write(f"=== Debug Test: {datetime.now().isoformat()} ===\n")
+            out.write(f"Command: {' '.join(cmd)}\n")
+            out.write("=== Full Output ===\n")
+        proc = subprocess.Popen(
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             text=True,
             encoding="utf-8",
             errors="replace",
-            timeout=60
+            bufsize=1
         )
+        # Kill on timeout from a timer so partial output already written is kept
+        timer = threading.Timer(60, lambda: (timed_out.set(), proc.kill()))
+        timer.start()
         
-        output = result.stdout or ""
-        
-        # Save to file if specified
-        if output_file:
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(f"=== Debug Test: {datetime.now().isoformat()} ===\n")
-                f.write(f"Command: {' '.join(cmd)}\n")
-                f.write(f"Return code: {result.returncode}\n")
-                f.write("=== Full Output ===\n")
-                f.write(output)
-            print(f"[debug-save] Output saved to {output_file}")
-        
-        # Extract just the AI response (after all the setup logs)
-        lines = output.splitlines()
+        # Extract just the AI response (after all the setup logs) while streaming
         ai_response = []
         capturing = False
-        
-        for line in lines:
-            # Look for the actual response after generate: line
-            if line.strip().startswith("generate: n_ctx"):
-                capturing = True
-                continue
-            elif capturing and not line.strip().startswith(("llama_perf", "llama_memory", "ggml_metal")):
-                if line.strip():
+        try:
+            for line in proc.stdout:
+                if out:
+                    out.write(line)
+                line = line.rstrip("\n")
+                # Look for the actual response after generate: line
+                if _GEN.match(line):
+                    capturing = True
+                elif capturing and line.strip() and not _SKIP.match(line):
                     ai_response.append(line)
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+        
+        if out:
+            out.write(f"\n=== Return code: {returncode}{' (timed out)' if timed_out.is_set() else ''} ===\n")
+            print(f"[debug-save] Output saved to {output_file}")
+        
+        if timed_out.is_set():
+            print("[debug-error] Command timed out after 60s")
+            return False, ""
         
         clean_response = "\n".join(ai_response).strip()
         
         print(f"[ai-response] {clean_response[:100]}{'...' if len(clean_response) > 100 else ''}")
-        print(f"[debug-status] Exit code: {result.returncode}")
+        print(f"[debug-status] Exit code: {returncode}")
         
-        return result.returncode == 0, clean_response
+        return returncode == 0, clean_response
         
-    except subprocess.TimeoutExpired:
-        print("[debug-error] Command timed out after 60s")
-        return False, ""
     except Exception as e:
         print(f"[debug-error] {e}")
         return False, ""
+    finally:
+        if out:
+            out.close()
 
 def main():
     print("=== Debug Diagnostics Runner ===")
@@ -108,17 +231,32 @@ def main():
     ]
     
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    output_files = [os.path.join(tests_dir, f"debug-test-{timestamp}-{i}.log")
+                    for i in range(1, len(test_prompts) + 1)]
     
-    for i, prompt in enumerate(test_prompts, 1):
-        print(f"\n--- Debug Test {i}/{len(test_prompts)} ---")
-        output_file = os.path.join(tests_dir, f"debug-test-{timestamp}-{i}.log")
-        
-        success, response = run_debug_test(prompt, output_file)
-        
-        if success:
-            print(f"[pass] Test {i} completed")
+    # Load the model once and send all prompts at once; llama.cpp's own logs go to the server log
+    server_log = os.path.join(tests_dir, f"debug-server-{timestamp}.log")
+    server = start_debug_server(server_log, len(test_prompts))
+    try:
+        if server is not None:
+            with ThreadPoolExecutor(max_workers=len(test_prompts)) as ex:
+                results = list(ex.map(run_server_test, test_prompts, output_files))
+            for i, (success, response) in enumerate(results, 1):
+                print(f"\n--- Debug Test {i}/{len(test_prompts)} ---")
+                print(f"[ai-response] {response[:100]}{'...' if len(response) > 100 else ''}")
+                print(f"[{'pass' if success else 'fail'}] Test {i} {'completed' if success else 'failed'}")
         else:
-            print(f"[fail] Test {i} failed")
+            for i, (prompt, output_file) in enumerate(zip(test_prompts, output_files), 1):
+                print(f"\n--- Debug Test {i}/{len(test_prompts)} ---")
+                
+                success, response = run_debug_test(prompt, output_file)
+                
+                if success:
+                    print(f"[pass] Test {i} completed")
+                else:
+                    print(f"[fail] Test {i} failed")
+    finally:
+        stop_debug_server(server)
     
     print(f"\n[debug-summary] Tests completed. Debug logs in {tests_dir}/")
 